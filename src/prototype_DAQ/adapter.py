@@ -41,7 +41,7 @@ class PrototypeDAQAdapter(ApiAdapter):
             self.protoDAQController.set(path, data)
             response = self.protoDAQController.get(path)
             status_code = 200
-        except PrototypeDAQControllerError as e:
+        except (PrototypeDAQControllerError, ParameterTreeError) as e:
             response = {'error': str(e)}
             status_code = 400
         except (TypeError, ValueError) as e:
@@ -6,8 +6,12 @@ proxy target and adaprers.
 
 Tim Nicholls, Ashley Neaves STFC Detector Systems Software Group.
 """
+import heapq
+import itertools
 import logging
+import threading
 import time
+from collections import deque
 import requests
 from requests.exceptions import HTTPError, RequestException
 from tornado.escape import json_encode
@@ -15,11 +19,347 @@ from tornado.escape import json_encode
 import tornado.httputil
 from odin.adapters.parameter_tree import ParameterTree, ParameterTreeError
 
+from prototype_DAQ.history import ParameterHistory, history_query_args
+from prototype_DAQ.profiling import profiler
+
 class TargetDecodeError(Exception):
     """Simple error class for raising target decode error exceptions."""
     pass
 
 
+class InFlightRequest(object):
+    """
+    Simple class representing a request to a proxy target that is currently in flight.
+
+    Identical requests issued while this request is in flight wait on its completion and share
+    its result rather than issuing a request of their own.
+    """
+
+    def __init__(self):
+        """Initialise the InFlightRequest object."""
+        self.done = threading.Event()
+        self.result = None
+
+
+class LatencyTracker(object):
+    """
+    Proxy target latency tracker.
+
+    This class records the latency of recent successful requests to a proxy target in a sliding
+    window, allowing percentiles of the observed latency to be calculated.
+    """
+
+    def __init__(self, window=100, min_samples=10):
+        """
+        Initialise the LatencyTracker object.
+
+        :param window: number of recent latency samples to retain
+        :param min_samples: minimum number of samples required to calculate a percentile
+        """
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, latency):
+        """
+        Record the latency of a request.
+
+        :param latency: request latency in seconds
+        """
+        with self._lock:
+            self._samples.append(latency)
+
+    def percentile(self, percent):
+        """
+        Calculate a percentile of the recorded latencies.
+
+        :param percent: percentile to calculate, in the range 0 to 100
+        :return: the latency percentile in seconds, or None if too few samples are recorded
+        """
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            samples = sorted(self._samples)
+        index = min(len(samples) - 1, int(round(percent / 100.0 * (len(samples) - 1))))
+        return samples[index]
+
+
+class RequestScheduler(object):
+    """
+    Proxy target request scheduler.
+
+    This class schedules the requests to a proxy target in priority order, allowing a limited
+    number of requests to be in progress at once. Requests in the control class, i.e. writes, are
+    always queued. Reads are shed rather than queued when the queue is saturated, with bulk reads
+    being shed once the queue is half full.
+    """
+
+    CONTROL = 0
+    STATUS = 1
+    BULK = 2
+    PRIORITY_NAMES = ('control', 'status', 'bulk')
+
+    def __init__(self, max_queue_depth=None, max_active=1):
+        """
+        Initialise the RequestScheduler object.
+
+        :param max_queue_depth: maximum depth of the queue of reads, None to disable scheduling
+        :param max_active: maximum number of requests in progress at once
+        """
+        self.max_queue_depth = max_queue_depth
+        self.max_active = max_active
+        self.queue_depths = [0] * len(self.PRIORITY_NAMES)
+        self.shed_counts = [0] * len(self.PRIORITY_NAMES)
+
+        self._queue = []
+        self._sequence = itertools.count()
+        self._active = 0
+        self._condition = threading.Condition()
+
+    @property
+    def enabled(self):
+        """Return True if scheduling is enabled."""
+        return self.max_queue_depth is not None
+
+    def acquire(self, priority):
+        """
+        Acquire a slot to send a request, waiting for higher priority requests to be sent first.
+
+        :param priority: priority class of the request
+        :return: True if the slot was acquired, False if the request was shed
+        """
+        if not self.enabled:
+            return True
+
+        with self._condition:
+            if self._active < self.max_active and not self._queue:
+                self._active += 1
+                return True
+
+            # Shed reads if the queue is saturated for their priority class
+            if priority != self.CONTROL:
+                shed_depth = self.max_queue_depth if priority == self.STATUS \
+                    else max(1, self.max_queue_depth // 2)
+                if len(self._queue) >= shed_depth:
+                    self.shed_counts[priority] += 1
+                    return False
+
+            # Queue the request and wait until it is at the head of the queue and a slot is free
+            ticket = (priority, next(self._sequence))
+            heapq.heappush(self._queue, ticket)
+            self.queue_depths[priority] += 1
+            while self._active >= self.max_active or self._queue[0] != ticket:
+                self._condition.wait()
+            heapq.heappop(self._queue)
+            self.queue_depths[priority] -= 1
+            self._active += 1
+            # Wake any other waiters in case a further slot is free
+            self._condition.notify_all()
+            return True
+
+    def release(self):
+        """Release the slot acquired to send a request."""
+        if not self.enabled:
+            return
+
+        with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+
+    def status(self):
+        """
+        Get the status of the scheduler.
+
+        :return: dict of the queue depth and shed count of each priority class
+        """
+        return {
+            'queue_depth': dict(zip(self.PRIORITY_NAMES, self.queue_depths)),
+            'shed': dict(zip(self.PRIORITY_NAMES, self.shed_counts)),
+        }
+
+
+class ProxyDataTree(object):
+    """
+    Indexed proxy target data tree.
+
+    This class holds the data or metadata received from a proxy target as a nested dictionary,
+    alongside a precompiled map of every path in the tree to its node. Lookups are resolved
+    directly from the map and merging a response body updates the map incrementally, so the cost
+    of both scales with the depth of the path and the size of the update rather than the size of
+    the whole tree.
+
+    The tree may be updated from threads other than the server IOLoop, e.g. write-behind flushes,
+    so access is serialised by a lock and data is returned as copies of the nodes in the tree.
+    """
+
+    def __init__(self):
+        """
+        Initialise the ProxyDataTree object.
+
+        Creates an empty root node and a path index containing only that root.
+        """
+        self.root = {}
+        self._index = {'': self.root}
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def parent_path(path):
+        """
+        Resolve the parent path of the specified path.
+
+        Responses from a target are keyed by the last element of the requested path, so are
+        merged into the tree at the parent of that path.
+
+        :param path: path to data on remote target
+        :return: normalised path of the parent node
+        """
+        path = path.strip('/')
+        return path.rsplit('/', 1)[0] if '/' in path else ''
+
+    def node(self, path):
+        """
+        Get a copy of the node in the tree at the specified path.
+
+        :param path: path to node in the tree
+        :return: copy of the node at the path, either a dict or a leaf value
+        """
+        with self._lock:
+            try:
+                return self._copy(self._index[path.strip('/')])
+            except KeyError:
+                raise ParameterTreeError("Invalid path: {}".format(path))
+
+    def get(self, path):
+        """
+        Get the data at the specified path in the tree.
+
+        The response is formatted in the same way as a ParameterTree get, i.e. keyed by the last
+        element of the path, or the whole tree for an empty path.
+
+        :param path: path to data in the tree
+        :return: dict of data at the path
+        """
+        path = path.strip('/')
+        node = self.node(path)
+        if not path:
+            return node
+        return {path.rsplit('/', 1)[-1]: node}
+
+    def merge(self, path, values):
+        """
+        Merge values into the tree at the specified path.
+
+        Intermediate nodes are created as necessary. Each key in the values replaces the existing
+        entry at that key, with the path index being updated only for the replaced entries.
+
+        :param path: path to the node to merge values into
+        :param values: dict of values to merge
+        """
+        path = path.strip('/')
+        with self._lock:
+            node = self._index.get(path)
+            if not isinstance(node, dict):
+                node = self._create_node(path)
+
+            for key, value in values.items():
+                self._assign(node, path, key, value)
+
+    def update(self, path, values):
+        """
+        Recursively update the tree with values at the specified path.
+
+        Unlike merge, nested dicts in the values are merged into the existing nodes rather than
+        replacing them, preserving any sibling entries already in the tree.
+
+        :param path: path to the node to update
+        :param values: nested dict of values to update
+        """
+        path = path.strip('/')
+        leaves = {}
+        with self._lock:
+            for key, value in values.items():
+                if isinstance(value, dict):
+                    self.update(path + '/' + key if path else key, value)
+                else:
+                    leaves[key] = value
+            if leaves:
+                self.merge(path, leaves)
+
+    @classmethod
+    def _copy(cls, node):
+        """
+        Copy a node of the tree, recursively copying nested dicts.
+
+        Leaf values are decoded from JSON responses and only ever replaced, never modified in
+        place, so do not need to be copied.
+
+        :param node: node to copy
+        :return: copy of the node
+        """
+        if isinstance(node, dict):
+            return dict((key, cls._copy(value)) for (key, value) in node.items())
+        return node
+
+    def _create_node(self, path):
+        """
+        Create the node at the specified path, along with any missing intermediate nodes.
+
+        :param path: normalised path of node to create
+        :return: the created node
+        """
+        node = self.root
+        prefix = ''
+        for elem in path.split('/'):
+            child = node.get(elem)
+            if not isinstance(child, dict):
+                child = {}
+                self._assign(node, prefix, elem, child)
+            prefix = prefix + '/' + elem if prefix else elem
+            node = child
+        return node
+
+    def _assign(self, node, prefix, key, value):
+        """
+        Assign a value to a key in a node, updating the path index accordingly.
+
+        :param node: node to assign value in
+        :param prefix: path of the node
+        :param key: key to assign value to
+        :param value: value to assign
+        """
+        path = prefix + '/' + key if prefix else key
+        old_value = node.get(key)
+        if isinstance(old_value, dict):
+            self._unindex(path, old_value)
+        node[key] = value
+        self._index_value(path, value)
+
+    def _index_value(self, path, value):
+        """
+        Add a value and, if it is a dict, all its descendants to the path index.
+
+        :param path: path of the value
+        :param value: value to index
+        """
+        self._index[path] = value
+        if isinstance(value, dict):
+            for key, child in value.items():
+                self._index_value(path + '/' + key, child)
+
+    def _unindex(self, path, node):
+        """
+        Remove all descendants of a node from the path index.
+
+        :param path: path of the node
+        :param node: node to remove descendants of
+        """
+        for key, child in node.items():
+            child_path = path + '/' + key
+            self._index.pop(child_path, None)
+            if isinstance(child, dict):
+                self._unindex(child_path, child)
+
+
 class BaseProxyTarget(object):
     """
     Proxy target base class.
@@ -28,7 +368,14 @@ class BaseProxyTarget(object):
     asynchronous implementations. It is not intended to be instantiated directly.
     """
 
-    def __init__(self, name, url, request_timeout):
+    # Parameters for adaptive GET timeouts: the timeout is scaled from the observed p99 GET latency
+    # and bounded below by the minimum and above by the configured request timeout or the maximum
+    ADAPTIVE_TIMEOUT_SCALE = 3.0
+    ADAPTIVE_TIMEOUT_MIN = 0.5
+    ADAPTIVE_TIMEOUT_MAX = 10.0
+
+    def __init__(self, name, url, request_timeout, write_behind_interval=None,
+                 adaptive_timeout=False, hedged_requests=False, max_queue_depth=None):
         """
         Initialise the BaseProxyTarget object.
 
@@ -39,18 +386,54 @@ class BaseProxyTarget(object):
         :param name: name of the proxy target
         :param url: URL of the remote target
         :param request_timeout: request timeout in seconds
+        :param write_behind_interval: write-behind flush deadline in seconds, None to disable
+        :param adaptive_timeout: flag enabling timeouts adapted to the observed request latency
+        :param hedged_requests: flag enabling hedged GET requests once p95 latency is exceeded
+        :param max_queue_depth: depth of the request queue at which reads are shed, None to disable
         """
         self.name = name
         self.url = url
         self.request_timeout = request_timeout
+        self.write_behind_interval = write_behind_interval
+        self.adaptive_timeout = adaptive_timeout
+        self.hedged_requests = hedged_requests
 
         # Initialise default state
         self.status_code = 0
         self.error_string = 'OK'
         self.last_update = 'unknown'
-        self.data = {}
-        self.metadata = {}
+        self.data_tree = ProxyDataTree()
+        self.meta_tree = ProxyDataTree()
+        self.data = self.data_tree.root
+        self.metadata = self.meta_tree.root
         self.counter = 0
+        self.coalesced_count = 0
+        self.hedged_count = 0
+
+        # Initialise the parameter history store, set by the containing adapter if enabled
+        self.history = None
+
+        # Initialise the tracker of observed request latency
+        self.latency = LatencyTracker()
+
+        # Initialise the scheduler of requests to the target, and the paths of data and metadata
+        # whose cached values are stale because requests for them were shed
+        self.scheduler = RequestScheduler(max_queue_depth)
+        self._stale_paths = {False: set(), True: set()}
+        self._stale_lock = threading.Lock()
+
+        # Initialise the map of GET requests currently in flight to the target
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+
+        # Initialise the write-behind queue of pending PUT requests to the target
+        self.pending_write_count = 0
+        self.failed_write_count = 0
+        self.last_flush_error = ''
+        self._pending_writes = {}
+        self._pending_lock = threading.Lock()
+        self._write_lock = threading.RLock()
+        self._flush_timer = None
 
         # Build a parameter tree representation of the proxy target status
         self.status_param_tree = ParameterTree({
@@ -58,11 +441,23 @@ class BaseProxyTarget(object):
             'status_code': (lambda: self.status_code, None),
             'error': (lambda: self.error_string, None),
             'last_update': (lambda: self.last_update, None),
+            'coalesced': (lambda: self.coalesced_count, None),
+            'pending_writes': (lambda: self.pending_write_count, None),
+            'failed_writes': (lambda: self.failed_write_count, None),
+            'last_flush_error': (lambda: self.last_flush_error, None),
+            'timeout': (self.resolve_timeout, None),
+            'latency_p95': (lambda: self.latency.percentile(95), None),
+            'hedged': (lambda: self.hedged_count, None),
+            'stale': {
+                'data': (lambda: self.stale_paths(False), None),
+                'metadata': (lambda: self.stale_paths(True), None),
+            },
+            'scheduler': (self.scheduler.status, None),
         })
 
         # Build a parameter tree representation of the proxy target data
-        self.data_param_tree = ParameterTree((lambda: self.data, None))
-        self.meta_param_tree = ParameterTree((lambda: self.metadata, None))
+        self.data_param_tree = ParameterTree((lambda: self.data_tree.get(''), None))
+        self.meta_param_tree = ParameterTree((lambda: self.meta_tree.get(''), None))
 
         # Set up default request headers
         self.request_headers = {
@@ -79,6 +474,67 @@ class BaseProxyTarget(object):
         response. The request is sent to the target by the implementation-specific _send_request
         method.
 
+        Concurrent identical requests are coalesced: if a request for the same path and metadata
+        flag is already in flight, this call waits for it to complete and shares its result
+        instead of sending another request to the target, e.g. when several clients poll the
+        same path.
+
+        :param path: path to data on remote target
+        :param get_metadata: flag indicating if metadata is to be requested
+        :return: True if the request was sent to the target, False if it was shed
+        """
+        key = (path.strip('/'), get_metadata)
+
+        # Register this request as in flight, or join an identical request already in flight
+        with self._in_flight_lock:
+            in_flight = self._in_flight.get(key)
+            if in_flight is None:
+                in_flight = self._in_flight[key] = InFlightRequest()
+                is_leader = True
+            else:
+                self.coalesced_count += 1
+                is_leader = False
+
+        if not is_leader:
+            in_flight.done.wait()
+            return in_flight.result
+
+        try:
+            in_flight.result = self._remote_get(path, get_metadata)
+        finally:
+            with self._in_flight_lock:
+                del self._in_flight[key]
+            in_flight.done.set()
+
+        return in_flight.result
+
+    def _remote_get(self, path, get_metadata):
+        """
+        Send a GET request to the remote target.
+
+        If the request scheduler sheds the request, the cached data is left in place and the
+        path recorded as stale.
+
+        :param path: path to data on remote target
+        :param get_metadata: flag indicating if metadata is to be requested
+        :return: True if the request was sent to the target, False if it was shed
+        """
+        priority = RequestScheduler.BULK if get_metadata else RequestScheduler.STATUS
+        if not self.scheduler.acquire(priority):
+            with self._stale_lock:
+                self._stale_paths[get_metadata].add(path.strip('/'))
+            return False
+
+        try:
+            self._send_get(path, get_metadata)
+        finally:
+            self.scheduler.release()
+        return True
+
+    def _send_get(self, path, get_metadata):
+        """
+        Create and send a GET request to the remote target.
+
         :param path: path to data on remote target
         :param get_metadata: flag indicating if metadata is to be requested
         """
@@ -94,13 +550,14 @@ class BaseProxyTarget(object):
             'method': 'GET',
             'url': self.url + path,
             'headers': headers,
-            'timeout': self.request_timeout
+            'timeout': self.resolve_timeout(),
+            'hedge_after': self.resolve_hedge_delay(),
         }
 
         # Send the request to the remote target
         return self._send_request(request, path, get_metadata)
 
-    def remote_set(self, path, data):
+    def remote_set(self, path, data, synchronous=False):
         """
         Set data on the remote target.
 
@@ -109,6 +566,184 @@ class BaseProxyTarget(object):
         response. The request is sent to the target by the implementation-specific _send_request
         method.
 
+        If write-behind is enabled for the target, the data is instead queued and sent with any
+        other pending writes when the queue is flushed. Synchronous writes flush any pending writes
+        first, preserving the order in which writes reach the target.
+
+        :param path: path to data on remote target
+        :param data: data to set on remote target
+        :param synchronous: flag indicating the data must be sent to the target immediately
+        """
+        if self.write_behind_interval is None or synchronous or not isinstance(data, dict):
+            with self._write_lock:
+                self.flush_writes()
+                return self._remote_set(path, data)
+
+        self._queue_write(path, data)
+
+    def flush_writes(self):
+        """
+        Flush the write-behind queue of the target.
+
+        Pending writes are collapsed into a single PUT request sent to the deepest path common
+        to all of them. If the target rejects the merged request, each pending write is retried
+        with its own PUT request so that one invalid write does not discard the others. Writes
+        that still fail are counted, and their queued values are dropped from the local data by
+        refreshing it from the target.
+        """
+        with self._write_lock:
+            with self._pending_lock:
+                if self._flush_timer is not None:
+                    self._flush_timer.cancel()
+                    self._flush_timer = None
+                pending = self._pending_writes
+                self._pending_writes = {}
+                self.pending_write_count = 0
+
+            if not pending:
+                return
+
+            # Descend through the pending writes while they share a single path
+            path_elems = []
+            data = pending
+            while len(data) == 1:
+                (key, value), = data.items()
+                if not isinstance(value, dict) or not value:
+                    break
+                path_elems.append(key)
+                data = value
+
+            path = '/'.join(path_elems)
+            self._remote_set(path, data)
+            if self.status_code == 200:
+                return
+
+            # The merged request failed. If the target rejected it, retry each pending write
+            # individually and refresh the local data of those still rejected. Otherwise the
+            # target could not be reached and all the writes have failed
+            writes = list(self._pending_leaves(path, data))
+            error_string = self._last_error()
+            if not self._write_rejected():
+                failed = ['/'.join(filter(None, (leaf_path, key))) for (leaf_path, key, _) in writes]
+                refresh_paths = []
+            else:
+                failed = []
+                for (leaf_path, key, value) in writes:
+                    if len(writes) > 1:
+                        self._remote_set(leaf_path, {key: value})
+                    if self.status_code != 200:
+                        failed.append('/'.join(filter(None, (leaf_path, key))))
+                        error_string = self._last_error()
+                refresh_paths = sorted(set(failed_path.rpartition('/')[0] for failed_path in failed))
+            if not failed:
+                return
+
+            self.failed_write_count += len(failed)
+            self.last_flush_error = "Write to {} failed: {}".format(', '.join(failed), error_string)
+            logging.error(
+                "Error: proxy target %s write-behind flush failed: %s",
+                self.name, self.last_flush_error
+            )
+
+            # Replace the queued values that were not applied with those of the target
+            for refresh_path in refresh_paths:
+                self.remote_get(refresh_path)
+
+    @classmethod
+    def _pending_leaves(cls, path, data):
+        """
+        Iterate over the leaf writes in a tree of pending writes.
+
+        :param path: path of the node of the pending write tree
+        :param data: node of the pending write tree
+        :return: iterator of (path, key, value) tuples for each leaf write
+        """
+        for key, value in data.items():
+            if isinstance(value, dict) and value:
+                yield from cls._pending_leaves(path + '/' + key if path else key, value)
+            else:
+                yield (path, key, value)
+
+    def _last_error(self):
+        """
+        Describe the error of the last request to the target.
+
+        :return: the error string of a failed request, or the status code of an error response
+        """
+        if self.error_string != 'OK':
+            return self.error_string
+        return "HTTP status {}".format(self.status_code)
+
+    def _write_rejected(self):
+        """
+        Check if the last request to the target was rejected by the target, rather than failing
+        because the target could not be reached.
+
+        :return: True if the target responded with a client error status
+        """
+        return 400 <= self.status_code < 500 and self.status_code != 408
+
+    def _queue_write(self, path, data):
+        """
+        Queue a write to the target in the write-behind queue.
+
+        Writes to the same path collapse to the latest value and writes to sibling paths are
+        merged into the same request body. The local data is updated immediately so that reads
+        reflect the queued value. A flush of the queue is scheduled if one is not already pending.
+
+        :param path: path to data on remote target
+        :param data: data to set on remote target
+        """
+        path = path.strip('/')
+        with self._pending_lock:
+            node = self._pending_writes
+            if path:
+                for elem in path.split('/'):
+                    child = node.get(elem)
+                    if not isinstance(child, dict):
+                        child = node[elem] = {}
+                    node = child
+            self._merge_pending(node, data)
+            self.pending_write_count += 1
+
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.write_behind_interval, self.flush_writes)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+        self.data_tree.update(path, data)
+
+    @classmethod
+    def _merge_pending(cls, node, data):
+        """
+        Recursively merge data into a node of the pending write tree.
+
+        :param node: node of the pending write tree
+        :param data: data to merge
+        """
+        for key, value in data.items():
+            if isinstance(value, dict) and isinstance(node.get(key), dict):
+                cls._merge_pending(node[key], value)
+            else:
+                node[key] = value
+
+    def _remote_set(self, path, data):
+        """
+        Send a PUT request to the remote target.
+
+        :param path: path to data on remote target
+        :param data: data to set on remote target
+        """
+        self.scheduler.acquire(RequestScheduler.CONTROL)
+        try:
+            return self._send_set(path, data)
+        finally:
+            self.scheduler.release()
+
+    def _send_set(self, path, data):
+        """
+        Create and send a PUT request to the remote target.
+
         :param path: path to data on remote target
         :param data: data to set on remote target
         """
@@ -116,7 +751,8 @@ class BaseProxyTarget(object):
         if isinstance(data, dict):
             data = json_encode(data)
 
-        # Create a PUT request dict to send to the _send_request method
+        # Create a PUT request dict to send to the _send_request method. PUT requests are not
+        # idempotent, so always use the configured request timeout rather than an adaptive one
         request = {
             'method': 'PUT',
             'url': self.url + path,
@@ -128,6 +764,65 @@ class BaseProxyTarget(object):
         # Send the request to the remote target
         return self._send_request(request, path)
     
+    def resolve_timeout(self):
+        """
+        Resolve the timeout to use for GET requests to the remote target.
+
+        If adaptive timeouts are enabled and sufficient latency samples have been recorded, the
+        timeout is scaled from the observed p99 GET latency of the target. Otherwise the configured
+        request timeout is used. PUT requests always use the configured request timeout.
+
+        :return: request timeout in seconds
+        """
+        if not self.adaptive_timeout:
+            return self.request_timeout
+
+        latency = self.latency.percentile(99)
+        if latency is None:
+            return self.request_timeout
+
+        max_timeout = self.request_timeout if self.request_timeout else self.ADAPTIVE_TIMEOUT_MAX
+        return min(max(latency * self.ADAPTIVE_TIMEOUT_SCALE, self.ADAPTIVE_TIMEOUT_MIN),
+                   max_timeout)
+
+    def resolve_hedge_delay(self):
+        """
+        Resolve the delay after which a hedged GET request is sent to the remote target.
+
+        :return: the observed p95 latency in seconds, or None if hedging is disabled or too few
+                 latency samples have been recorded
+        """
+        if not self.hedged_requests:
+            return None
+        return self.latency.percentile(95)
+
+    def stale_paths(self, get_metadata):
+        """
+        Get the paths whose cached values are stale because requests for them were shed.
+
+        :param get_metadata: flag indicating if metadata paths are to be returned
+        :return: sorted list of stale paths, with an empty path indicating the whole tree
+        """
+        with self._stale_lock:
+            return sorted(self._stale_paths[get_metadata])
+
+    def _clear_stale(self, path, get_metadata):
+        """
+        Clear the stale paths refreshed by a successful request, i.e. the path and its descendants.
+
+        :param path: path of data refreshed by the request
+        :param get_metadata: flag indicating if metadata was requested
+        """
+        path = path.strip('/')
+        with self._stale_lock:
+            stale_paths = self._stale_paths[get_metadata]
+            if not stale_paths:
+                return
+            self._stale_paths[get_metadata] = set(
+                stale_path for stale_path in stale_paths
+                if path and stale_path != path and not stale_path.startswith(path + '/')
+            )
+
     def _process_response(self, response, path, get_metadata):
         """
         Process a response from the remote target.
@@ -148,7 +843,8 @@ class BaseProxyTarget(object):
             # Decode the reponse body, handling errors by re-processing the repsonse as an
             # exception. Otherwise, update the target data and status based on the response.
             try:
-                response_body = response.json()
+                with profiler.span('proxy.parse'):
+                    response_body = response.json()
             except ValueError as decode_error:
                 error_string = "Failed to decode response body: {}".format(str(decode_error))
                 self._process_response(TargetDecodeError(error_string), path, get_metadata)
@@ -156,21 +852,24 @@ class BaseProxyTarget(object):
                 # Update status code, errror string and data accordingly
                 self.status_code = response.status_code
                 self.error_string = 'OK'
-                # Set a reference to the data or metadata to update as necessary
-                data_ref = self.metadata if get_metadata else self.data
-                # If a path was specified, parse it and descend to the appropriate location in the
-                # data struture
-                if path:
-                    path_elems = path.split('/')
-                    # Remove empty string caused by trailing slashes
-                    if path_elems[-1] == '':
-                        del path_elems[-1]
-                    # Traverse down the data tree for each element
-                    for elem in path_elems[:-1]:
-                        data_ref = data_ref.setdefault(elem, {})
-                # Update the data or metadata with the body of the response
-                for key in response_body:
-                    data_ref[key] = response_body[key]
+                self._clear_stale(path, get_metadata)
+                # Merge the body of the response into the data or metadata tree at the parent of
+                # the specified path
+                with profiler.span('proxy.merge'):
+                    tree = self.meta_tree if get_metadata else self.data_tree
+                    tree.merge(tree.parent_path(path), response_body)
+
+                    # Record the history of the updated data if enabled
+                    if not get_metadata and self.history is not None:
+                        self.history.record_tree(
+                            self.name + '/' + tree.parent_path(path), response_body
+                        )
+
+                    # Reapply any pending writes so that stale values from the target do not
+                    # mask them
+                    if not get_metadata and self._pending_writes:
+                        with self._pending_lock:
+                            self.data_tree.update('', self._pending_writes)
 
         # Otherwise, handle the exception, updating status information and reporting the error
         elif isinstance(response, Exception):
@@ -196,6 +895,19 @@ class BaseProxyAdapter(object):
     implementations.
     """
     TIMEOUT_CONFIG_NAME = 'request_timeout'
+    WRITE_BEHIND_CONFIG_NAME = 'write_behind_interval'
+    ADAPTIVE_TIMEOUT_CONFIG_NAME = 'adaptive_timeout'
+    HEDGED_REQUESTS_CONFIG_NAME = 'hedged_requests'
+    QUEUE_DEPTH_CONFIG_NAME = 'max_queue_depth'
+    HISTORY_INTERVAL_CONFIG_NAME = 'history_interval'
+    HISTORY_PATH = 'history'
+
+    # HTTP status code of responses served from cached data because reads of one or more targets
+    # were shed by their request schedulers, i.e. 203 Non-Authoritative Information
+    STALE_STATUS_CODE = 203
+    # Request header used by clients to require a PUT is sent to the targets immediately,
+    # bypassing the write-behind queue
+    SYNC_WRITE_HEADER = 'Sync-Write'
     TARGET_CONFIG_NAME = 'targets'
 
     def initialise_proxy(self, proxy_target_cls):
@@ -209,6 +921,64 @@ class BaseProxyAdapter(object):
 
         :param proxy_target_cls: proxy target class appropriate for the specific implementation
         """
+        # Parse the adapter options, instantiating a proxy target of the specified type for each
+        # target specified.
+        (target_specs, target_kwargs) = self._parse_proxy_options()
+        self.targets = [
+            proxy_target_cls(name, url, **target_kwargs) for (name, url) in target_specs
+        ]
+
+        # Build the parameter trees implemented by this adapter for the specified proxy targets
+        self._build_proxy_trees()
+        self.start_history_refresh()
+
+    def start_history_refresh(self):
+        """
+        Start the periodic refresh of the data covered by the parameter history.
+
+        If parameter history and a history interval are enabled, a background thread reads the
+        data at the paths covered by the history patterns from the targets at each interval, so
+        that history is recorded whether or not clients are reading the data.
+        """
+        self._history_stop = threading.Event()
+        self._history_thread = None
+        if self.history is None or self.history_interval is None:
+            return
+
+        self._history_thread = threading.Thread(
+            target=self._refresh_history, args=(self.history.refresh_paths(),), daemon=True
+        )
+        self._history_thread.start()
+
+    def stop_history_refresh(self):
+        """Stop the periodic refresh of the data covered by the parameter history."""
+        self._history_stop.set()
+        if self._history_thread is not None:
+            self._history_thread.join()
+            self._history_thread = None
+
+    def _refresh_history(self, paths):
+        """
+        Refresh the data at the specified paths from the targets at each history interval.
+
+        :param paths: list of paths of data to refresh
+        """
+        while not self._history_stop.wait(self.history_interval):
+            for path in paths:
+                try:
+                    self.proxy_get(path, False)
+                except Exception as refresh_error:
+                    logging.error("Failed to refresh proxy history path %s: %s", path, refresh_error)
+
+    def _parse_proxy_options(self):
+        """
+        Parse the proxy adapter options.
+
+        This method parses the adapter options to determine the list of proxy targets and the
+        keyword arguments, e.g. request timeout, with which each proxy target is to be created.
+
+        :return: tuple of list of target name and URL pairs, and dict of target keyword arguments
+        """
         # Set the HTTP request timeout if present in the options
         request_timeout = None
         if self.TIMEOUT_CONFIG_NAME in self.options:
@@ -221,27 +991,103 @@ class BaseProxyAdapter(object):
                     self.options[self.TIMEOUT_CONFIG_NAME]
                 )
 
-        # Parse the list of target-URL pairs from the options, instantiating a proxy target of the
-        # specified type for each target specified.
-        self.targets = []
+        # Set the write-behind flush interval if present in the options, enabling write-behind
+        write_behind_interval = None
+        if self.WRITE_BEHIND_CONFIG_NAME in self.options:
+            try:
+                write_behind_interval = float(self.options[self.WRITE_BEHIND_CONFIG_NAME])
+                logging.debug(
+                    'Proxy adapter write-behind interval set to %f secs', write_behind_interval
+                )
+            except ValueError:
+                logging.error(
+                    "Illegal write-behind interval specified for proxy adapter: %s",
+                    self.options[self.WRITE_BEHIND_CONFIG_NAME]
+                )
+
+        # Set the adaptive timeout and hedged request flags from the options
+        adaptive_timeout = self._get_bool_option(self.ADAPTIVE_TIMEOUT_CONFIG_NAME)
+        hedged_requests = self._get_bool_option(self.HEDGED_REQUESTS_CONFIG_NAME)
+        logging.debug(
+            'Proxy adapter adaptive timeouts %s, hedged requests %s',
+            'enabled' if adaptive_timeout else 'disabled',
+            'enabled' if hedged_requests else 'disabled'
+        )
+
+        # Set the maximum request queue depth if present in the options, enabling scheduling
+        max_queue_depth = None
+        if self.QUEUE_DEPTH_CONFIG_NAME in self.options:
+            try:
+                max_queue_depth = int(self.options[self.QUEUE_DEPTH_CONFIG_NAME])
+                logging.debug('Proxy adapter maximum queue depth set to %d', max_queue_depth)
+            except ValueError:
+                logging.error(
+                    "Illegal maximum queue depth specified for proxy adapter: %s",
+                    self.options[self.QUEUE_DEPTH_CONFIG_NAME]
+                )
+
+        target_kwargs = {
+            'request_timeout': request_timeout,
+            'write_behind_interval': write_behind_interval,
+            'adaptive_timeout': adaptive_timeout,
+            'hedged_requests': hedged_requests,
+            'max_queue_depth': max_queue_depth,
+        }
+
+        # Create the parameter history store if history path patterns are present in the options
+        self.history = ParameterHistory.from_options(self.options)
+
+        # Set the interval at which the data covered by the history is refreshed from the targets
+        # if present in the options. Otherwise history is only recorded when clients read the data
+        self.history_interval = None
+        if self.HISTORY_INTERVAL_CONFIG_NAME in self.options:
+            try:
+                self.history_interval = float(self.options[self.HISTORY_INTERVAL_CONFIG_NAME])
+                if self.history_interval <= 0:
+                    raise ValueError
+                logging.debug(
+                    'Proxy adapter history interval set to %f secs', self.history_interval
+                )
+            except ValueError:
+                self.history_interval = None
+                logging.error(
+                    "Illegal history interval specified for proxy adapter: %s",
+                    self.options[self.HISTORY_INTERVAL_CONFIG_NAME]
+                )
+
+        # Parse the list of target-URL pairs from the options
+        target_specs = []
         if self.TARGET_CONFIG_NAME in self.options:
             for target_str in self.options[self.TARGET_CONFIG_NAME].split(','):
                 try:
                     (target, url) = target_str.split('=')
-                    self.targets.append(
-                        proxy_target_cls(target.strip(), url.strip(), request_timeout)
-                    )
+                    target_specs.append((target.strip(), url.strip()))
                 except ValueError:
                     logging.error("Illegal target specification for proxy adapter: %s",
                                   target_str.strip())
 
+        return (target_specs, target_kwargs)
+
+    def _build_proxy_trees(self):
+        """
+        Build the parameter trees implemented by the proxy adapter.
+
+        This method builds the data, metadata and status parameter trees for the proxy targets
+        of the adapter, along with a map of target names to targets.
+        """
+        # Build a map of target names to targets for direct lookup of target paths
+        self.target_map = dict((target.name, target) for target in self.targets)
+
+        # Set the parameter history store used by the targets
+        for target in self.targets:
+            target.history = self.history
+
         # Issue an error message if no targets were loaded
         if self.targets:
             logging.debug("Proxy adapter with {:d} targets loaded".format(len(self.targets)))
         else:
             logging.error("Failed to resolve targets for proxy adapter")
 
-        # Build the parameter trees implemented by this adapter for the specified proxy targets
         status_dict = {}
         tree = {}
         meta_tree = {}
@@ -269,7 +1115,7 @@ class BaseProxyAdapter(object):
 
         :param path: path to data on remote targets
         :param get_metadata: flag indicating if metadata is to be requested
-        :return: list of target responses
+        :return: list of flags indicating if the request to each target was sent or shed
         """
         # Resolve the path element and target path
         path_elem, target_path = self._resolve_path(path)
@@ -282,7 +1128,7 @@ class BaseProxyAdapter(object):
 
         return target_responses
 
-    def proxy_set(self, path, data):
+    def proxy_set(self, path, data, synchronous=False):
         """
         Set data on the proxy targets.
 
@@ -290,6 +1136,7 @@ class BaseProxyAdapter(object):
 
         :param path: path to data on remote targets
         :param data to set on targets
+        :param synchronous: flag indicating the data must be sent to the targets immediately
         :return: list of target responses
         """
         # Resolve the path element and target path
@@ -299,10 +1146,19 @@ class BaseProxyAdapter(object):
         target_responses = []
         for target in self.targets:
             if path_elem == '' or path_elem == target.name:
-                target_responses.append(target.remote_set(target_path, data))
+                target_responses.append(target.remote_set(target_path, data, synchronous))
 
         return target_responses
 
+    def flush_writes(self):
+        """
+        Flush the write-behind queues of all proxy targets.
+
+        This method sends any writes pending in the write-behind queue of each target immediately.
+        """
+        for target in self.targets:
+            target.flush_writes()
+
     def _resolve_response(self, path, get_metadata=False):
         """
         Resolve the response to a proxy target get or set request.
@@ -317,16 +1173,28 @@ class BaseProxyAdapter(object):
         # Build the response from the adapter parameter trees, matching to the path for one or more
         # targets
         try:
-            # If metadata is requested, update the status tree with metadata before returning
-            # metadata
+            # If metadata is requested, resolve the status metadata from the live status tree, since
+            # status value types may change, e.g. latency statistics once samples are recorded
             if get_metadata:
-                path_elem, _ = self._resolve_path(path)
-                if path_elem in ("", "status"):
-                    # update status tree with metadata
-                    self.meta_param_tree.set('status', self.status_tree.get("", True))
-                response = self.meta_param_tree.get(path)
+                path_elem, status_path = self._resolve_path(path)
+                if path_elem == "status":
+                    if status_path.strip('/'):
+                        response = self.status_tree.get(status_path, True)
+                    else:
+                        response = {'status': self.status_tree.get("", True)}
+                else:
+                    response = self.meta_param_tree.get(path)
+                    if path_elem == "":
+                        response = dict(response, status=self.status_tree.get("", True))
             else:
-                response = self.param_tree.get(path)
+                # Resolve paths within a target directly from the indexed target data tree,
+                # avoiding populating the entire tree for that target
+                path_elem, target_path = self._resolve_path(path)
+                target = self.target_map.get(path_elem)
+                if target is not None and target_path.strip('/'):
+                    response = target.data_tree.get(target_path)
+                else:
+                    response = self.param_tree.get(path)
             status_code = 200
         except ParameterTreeError as param_tree_err:
             response = {'error': str(param_tree_err)}
@@ -334,6 +1202,37 @@ class BaseProxyAdapter(object):
 
         return (response, status_code)
 
+    def _get_bool_option(self, name):
+        """
+        Get the value of a boolean option from the adapter options.
+
+        :param name: name of the option
+        :return: True if the option is present and set to a true value, otherwise False
+        """
+        return str(self.options.get(name, False)).strip().lower() in ('1', 'true', 'yes', 'on')
+
+    def _resolve_history(self, path, request):
+        """
+        Resolve the response to a parameter history request.
+
+        This method resolves the history of the parameter at the specified path over the time
+        range given by the request query arguments, along with an appropriate HTTP status code.
+
+        :param path: path to the parameter, including the target name
+        :param request: HTTP request object
+        """
+        if self.history is None:
+            return ({'error': 'Parameter history is not enabled'}, 400)
+
+        try:
+            response = self.history.get(path, **history_query_args(request))
+            status_code = 200
+        except (ParameterTreeError, ValueError) as history_err:
+            response = {'error': str(history_err)}
+            status_code = 400
+
+        return (response, status_code)
+
     @staticmethod
     def _resolve_path(path):
         """
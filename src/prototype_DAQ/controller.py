@@ -4,15 +4,20 @@ from functools import partial
 import os
 import signal
 import sys
+import time
+from concurrent import futures
+from copy import deepcopy
 from odin.adapters.parameter_tree import ParameterTree, ParameterTreeError
 from odin.adapters.adapter import ApiAdapterRequest, ApiAdapterResponse
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
+from prototype_DAQ.base_proxy import BaseProxyAdapter
+from prototype_DAQ.profiling import profiler
 
 @dataclass
 class Adapters:
     system_info: object
     dummy: object
-   #loki_proxy: object
+    loki_proxy: object = None
 
 class PrototypeDAQController:
     """Class to manage the other adapters in the system."""
@@ -24,20 +29,53 @@ class PrototypeDAQController:
         self.test_value = "Test String from main IAC Adapter"
         # Initialize the parameter tree and adpater dataclass after adapters are loaded
         self.adapters = None 
+        self.adapter_map = {}
         self.param_tree = None
 
+        # Stored configuration snapshots, and the cached live configuration of each adapter
+        self.snapshots = {}
+        self.live_config = {}
+        self.last_snapshot = ""
+        self.last_apply = {'snapshot': "", 'changed': 0, 'requests': 0, 'duration': 0.0}
+        self.config_executor = futures.ThreadPoolExecutor(max_workers=8)
+
     def initialize_adapters(self, adapters):
         """Get access to all of the other adapters."""
-        self.adapters = Adapters(**adapters)
+        # Adapters declared in the dataclass are accessed by name, while the configuration API
+        # covers every loaded adapter, declared or not
+        self.adapter_map = dict(adapters)
+        declared = [field.name for field in fields(Adapters)]
+        self.adapters = Adapters(**dict(
+            (name, adapter) for (name, adapter) in adapters.items() if name in declared
+        ))
         logging.debug(f"Adapters loaded: {self.adapters}")      
+        undeclared = [name for name in adapters if name not in declared]
+        if undeclared:
+            logging.debug(f"Adapters loaded without a controller field: {undeclared}")
 
         logging.debug(f"retrieveing dummy enable: {self.iac_get(self.adapters.dummy, 'enable', param='enable')}")
 
         self.param_tree = ParameterTree({
             'test_value': (lambda: self.test_value, None),
-            'dummy_enable': (lambda: self.iac_get(self.adapters.dummy, 'enable', param='enable'), self.set_dummy_bgt)
+            'dummy_enable': (lambda: self.iac_get(self.adapters.dummy, 'enable', param='enable'), self.set_dummy_bgt),
+            'config': {
+                'snapshot': (lambda: self.last_snapshot, self.snapshot_config),
+                'apply': (lambda: self.last_apply['snapshot'], self.apply_config),
+                'refresh': (None, lambda _: self.refresh_live_config()),
+                'snapshots': (lambda: sorted(self.snapshots), None),
+                'changed': (lambda: self.last_apply['changed'], None),
+                'requests': (lambda: self.last_apply['requests'], None),
+                'duration': (lambda: self.last_apply['duration'], None),
+            },
+            'profiling': {
+                'enable': (lambda: profiler.enabled, profiler.enable),
+                'reset': (None, lambda _: profiler.reset()),
+                'spans': (profiler.span_stats, None),
+                'sample': (lambda: profiler.sample_duration, profiler.start_sampling),
+                'sampling': (lambda: profiler.sampling, None),
+                'samples': (lambda: profiler.samples, None),
+            }
         })
-        self.sync_toggle_iac()
 
     def get(self, path):
         """Get the parameter tree from the controller."""
@@ -49,18 +87,229 @@ class PrototypeDAQController:
 
     def iac_get(self, adapter, path, **kwargs):
         """Generic IAC get method for synchronous adapters."""
-        request = ApiAdapterRequest(None, accept="application/json")
-        response = adapter.get(path, request)
+        accept = "application/json;metadata=true" if kwargs.get('metadata') else "application/json"
+        request = ApiAdapterRequest(None, accept=accept)
+        with profiler.span('controller.iac_get'):
+            response = self._iac_handler(adapter, 'get')(path, request)
         if response.status_code != 200:
             logging.debug(f"IAC GET failed for adapter {adapter}, path {path}: {response.data}")
         return response.data.get(kwargs['param']) if 'param' in kwargs else response.data
 
     def iac_set(self, adapter, path, param, data):
         """Generic IAC set method for synchronous adapters."""
-        request = ApiAdapterRequest({param: data}, content_type="application/vnd.odin-native")
-        response = adapter.put(path, request)
+        return self.iac_put(adapter, path, {param: data})
+
+    def iac_put(self, adapter, path, data):
+        """
+        Generic IAC set method for synchronous adapters, setting a nested dict of parameters.
+
+        Writes to proxy adapters are sent to the remote targets before returning, rather than
+        being queued for write-behind.
+        """
+        request = ApiAdapterRequest(data, content_type="application/vnd.odin-native")
+        request.headers[BaseProxyAdapter.SYNC_WRITE_HEADER] = 'true'
+        with profiler.span('controller.iac_put'):
+            response = self._iac_handler(adapter, 'put')(path, request)
         if response.status_code != 200:
             logging.debug(f"IAC SET failed for adapter {adapter}, path {path}: {response.data}")
+        return response.status_code == 200
+
+    @staticmethod
+    def _iac_handler(adapter, method):
+        """Resolve the IAC request handler of an adapter, using the synchronous handler of async adapters."""
+        if getattr(adapter, 'is_async', False):
+            return getattr(adapter, method + '_sync')
+        return getattr(adapter, method)
+
+    def snapshot_config(self, name):
+        """
+        Capture a snapshot of the configuration of all loaded adapters.
+
+        The writeable parameters of each adapter, including those of any proxied targets, are read
+        and stored under the given snapshot name.
+        """
+        config = self.refresh_live_config()
+        self.snapshots[name] = deepcopy(config)
+        self.last_snapshot = name
+        logging.debug(f"Configuration snapshot {name} captured for adapters: {list(config)}")
+
+    def apply_config(self, name):
+        """
+        Apply a stored configuration snapshot to the loaded adapters.
+
+        The live configuration is re-read and the snapshot is diffed against it, so that only
+        changed parameters are written. Changes are grouped into one IAC request per adapter
+        target, or per adapter for parameters at the top level. Requests to proxy adapters are sent
+        in parallel, while those to local adapters are made in turn on the calling thread.
+        """
+        if name not in self.snapshots:
+            raise PrototypeDAQControllerError(f"No configuration snapshot named {name}")
+
+        start_time = time.time()
+        self.refresh_live_config()
+
+        # Build the grouped requests for the changed parameters of each adapter
+        config_requests = []
+        changed = 0
+        for adapter_name, config in self.snapshots[name].items():
+            if adapter_name not in self.adapter_map:
+                logging.debug(f"Adapter {adapter_name} in snapshot {name} is not loaded")
+                continue
+            changes = self._diff_config(config, self.live_config.get(adapter_name, {}))
+            changed += self._count_leaves(changes)
+            top_level = {}
+            for key, value in changes.items():
+                if isinstance(value, dict):
+                    config_requests.append((adapter_name, key, value))
+                else:
+                    top_level[key] = value
+            if top_level:
+                config_requests.append((adapter_name, '', top_level))
+
+        # Send the requests, updating the cached live configuration as they succeed
+        results = self._run_iac(
+            lambda request: self._apply_request(self.adapter_map[request[0]], request[1], request[2]),
+            config_requests, [self.adapter_map[request[0]] for request in config_requests]
+        )
+        for (adapter_name, path, data), success in zip(config_requests, results):
+            if success:
+                live = self.live_config.setdefault(adapter_name, {})
+                self._merge_config(live.setdefault(path, {}) if path else live, data)
+
+        self.last_apply = {
+            'snapshot': name,
+            'changed': changed,
+            'requests': len(config_requests),
+            'duration': time.time() - start_time,
+        }
+        logging.debug(
+            f"Configuration snapshot {name} applied: {changed} parameters changed in "
+            f"{len(config_requests)} requests"
+        )
+
+    def _apply_request(self, adapter, path, data):
+        """
+        Send a grouped configuration request to an adapter, returning whether it succeeded.
+
+        Proxy adapters respond to a PUT with the cached data of the target even if the remote
+        request failed, so the status of the targets written is also checked.
+        """
+        if not self.iac_put(adapter, path, data):
+            return False
+        if isinstance(adapter, BaseProxyAdapter):
+            names = [path.split('/')[0]] if path else list(data)
+            return all(
+                adapter.target_map[name].status_code == 200
+                for name in names if name in adapter.target_map
+            )
+        return True
+
+    def refresh_live_config(self):
+        """
+        Refresh the cached live configuration of all loaded adapters.
+
+        The data of every proxy target is first refreshed from the remote targets in parallel on
+        the config executor, after which the configuration of each adapter is read locally.
+        """
+        refreshes = [
+            self.config_executor.submit(adapter.proxy_get, target.name, False)
+            for adapter in self.adapter_map.values() if isinstance(adapter, BaseProxyAdapter)
+            for target in adapter.targets
+        ]
+        for refresh in refreshes:
+            refresh.result()
+
+        self.live_config = dict(
+            (adapter_name, self._read_config(adapter))
+            for (adapter_name, adapter) in self.adapter_map.items()
+        )
+        return self.live_config
+
+    def _read_config(self, adapter):
+        """
+        Read the writeable configuration of an adapter.
+
+        The configuration of a proxy adapter is read from the data tree of each target, using the
+        target metadata to identify writeable parameters. Other adapters are read with an IAC
+        request for their parameter tree with metadata.
+        """
+        if not isinstance(adapter, BaseProxyAdapter):
+            return self._writeable_config(self.iac_get(adapter, '', metadata=True))
+
+        config = {}
+        for target in adapter.targets:
+            target_config = self._writeable_config(target.meta_tree.get(''), target.data_tree.get(''))
+            if target_config:
+                config[target.name] = target_config
+        return config
+
+    def _run_iac(self, func, items, adapters):
+        """
+        Run an IAC function for each item, returning the results in order.
+
+        Items targeting proxy adapters are run in parallel on the config executor, since their
+        time is spent waiting on remote targets. Other adapters may rely on running in the server
+        IOLoop thread, so their items are run in turn on the calling thread.
+        """
+        pending = [
+            self.config_executor.submit(func, item) if isinstance(adapter, BaseProxyAdapter) else None
+            for (item, adapter) in zip(items, adapters)
+        ]
+        return [
+            result.result() if result is not None else func(item)
+            for (item, result) in zip(items, pending)
+        ]
+
+    @classmethod
+    def _writeable_config(cls, tree, values=None):
+        """
+        Extract the values of the writeable parameters from a parameter tree with metadata.
+
+        If a tree of current values is given, values are taken from it in preference to those in
+        the metadata.
+        """
+        if not isinstance(tree, dict):
+            return {}
+        values = values if isinstance(values, dict) else {}
+        config = {}
+        for key, value in tree.items():
+            if isinstance(value, dict) and 'value' in value and 'writeable' in value:
+                if value['writeable']:
+                    config[key] = deepcopy(values.get(key, value['value']))
+            elif isinstance(value, dict):
+                subtree = cls._writeable_config(value, values.get(key))
+                if subtree:
+                    config[key] = subtree
+        return config
+
+    @classmethod
+    def _diff_config(cls, config, live):
+        """Return the nested dict of parameters in a configuration that differ from the live one."""
+        changes = {}
+        for key, value in config.items():
+            live_value = live.get(key) if isinstance(live, dict) else None
+            if isinstance(value, dict):
+                subtree = cls._diff_config(value, live_value if isinstance(live_value, dict) else {})
+                if subtree:
+                    changes[key] = subtree
+            elif key not in live or live_value != value:
+                changes[key] = value
+        return changes
+
+    @classmethod
+    def _merge_config(cls, config, changes):
+        """Merge a nested dict of changed parameters into a configuration."""
+        for key, value in changes.items():
+            if isinstance(value, dict) and isinstance(config.get(key), dict):
+                cls._merge_config(config[key], value)
+            else:
+                config[key] = deepcopy(value)
+
+    @classmethod
+    def _count_leaves(cls, tree):
+        """Count the leaf parameters in a nested dict."""
+        return sum(cls._count_leaves(value) if isinstance(value, dict) else 1
+                   for value in tree.values())
 
     # def sync_toggle_iac(self):
     #     """
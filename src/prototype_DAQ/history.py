@@ -0,0 +1,279 @@
+"""
+Parameter history classes for the prototype DAQ adapters.
+
+This module implements an optional history store for parameter tree leaves. Leaves opt in to
+having their history recorded by matching one of a set of path patterns, with samples of each
+leaf held as (timestamp, value) pairs in a compact preallocated ring buffer. Time ranges of the
+history can be queried and decimated to a maximum number of points, allowing clients to draw
+trends without polling parameters at high rates.
+
+Josh Harris, STFC Detector Systems Software Group.
+"""
+import bisect
+import fnmatch
+import logging
+import threading
+import time
+from array import array
+
+from odin.adapters.parameter_tree import ParameterTreeError
+
+
+class HistoryBuffer(object):
+    """
+    Parameter history ring buffer.
+
+    This class holds the most recent samples of a single parameter in preallocated arrays of
+    timestamps and values, overwriting the oldest samples once the buffer is full.
+    """
+
+    def __init__(self, depth):
+        """
+        Initialise the HistoryBuffer object.
+
+        :param depth: maximum number of samples held in the buffer
+        """
+        self.depth = depth
+        self.timestamps = array('d', bytes(8 * depth))
+        self.values = array('d', bytes(8 * depth))
+        self.count = 0
+
+    def __len__(self):
+        """Return the number of samples held in the buffer."""
+        return min(self.count, self.depth)
+
+    def append(self, timestamp, value):
+        """
+        Append a sample to the buffer.
+
+        :param timestamp: timestamp of the sample
+        :param value: value of the sample
+        """
+        index = self.count % self.depth
+        self.timestamps[index] = timestamp
+        self.values[index] = value
+        self.count += 1
+
+    def query(self, start=None, end=None, max_points=None):
+        """
+        Query a time range of samples in the buffer.
+
+        If the range contains more samples than the maximum number of points, the samples are
+        decimated into that number of equally sized buckets, returning the timestamp of the first
+        sample and the mean, minimum and maximum value of each bucket.
+
+        :param start: start of the time range, or None for the oldest sample
+        :param end: end of the time range, or None for the newest sample
+        :param max_points: maximum number of points to return, or None for no decimation
+        :return: dict of lists of timestamps, values and the minimum and maximum of each point
+        """
+        # Resolve the range of samples to return in chronological order
+        oldest = self.count - len(self)
+        times = _ChronologicalView(self.timestamps, oldest, len(self))
+        first = bisect.bisect_left(times, start) if start is not None else 0
+        last = bisect.bisect_right(times, end) if end is not None else len(times)
+        num_samples = max(0, last - first)
+
+        bucket_size = 1
+        if max_points and num_samples > max_points:
+            bucket_size = -(-num_samples // max_points)
+
+        result = {'timestamps': [], 'values': [], 'min': [], 'max': []}
+        for bucket_start in range(first, last, bucket_size):
+            bucket_end = min(bucket_start + bucket_size, last)
+            values = [
+                self.values[(oldest + index) % self.depth]
+                for index in range(bucket_start, bucket_end)
+            ]
+            result['timestamps'].append(times[bucket_start])
+            result['values'].append(sum(values) / len(values))
+            result['min'].append(min(values))
+            result['max'].append(max(values))
+
+        return result
+
+
+class _ChronologicalView(object):
+    """Sequence view of a ring buffer array in chronological order, for use with bisect."""
+
+    def __init__(self, data, oldest, length):
+        self.data = data
+        self.oldest = oldest
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        return self.data[(self.oldest + index) % len(self.data)]
+
+
+class ParameterHistory(object):
+    """
+    Parameter history store.
+
+    This class records the history of the parameter tree leaves whose paths match one of a set of
+    patterns, using shell-style wildcards, e.g. node_1/acquisition/*. Only numeric and boolean
+    values are recorded.
+    """
+
+    DEFAULT_DEPTH = 3600
+
+    def __init__(self, patterns, depth=DEFAULT_DEPTH):
+        """
+        Initialise the ParameterHistory object.
+
+        :param patterns: list of path patterns of the leaves to record
+        :param depth: maximum number of samples recorded for each leaf
+        """
+        if depth < 1:
+            raise ValueError("History depth must be at least 1: {}".format(depth))
+        self.patterns = [pattern.strip().strip('/') for pattern in patterns if pattern.strip()]
+        self.depth = depth
+        self.buffers = {}
+        self._matches = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_options(cls, options, patterns_name='history', depth_name='history_depth'):
+        """
+        Create a parameter history store from adapter options.
+
+        :param options: dict of adapter options
+        :param patterns_name: name of the option specifying comma-separated path patterns
+        :param depth_name: name of the option specifying the history depth
+        :return: a ParameterHistory object, or None if no patterns are specified
+        """
+        patterns = [pattern for pattern in options.get(patterns_name, '').split(',')
+                    if pattern.strip()]
+        if not patterns:
+            return None
+
+        depth = cls.DEFAULT_DEPTH
+        if depth_name in options:
+            try:
+                depth = int(options[depth_name])
+                if depth < 1:
+                    raise ValueError
+            except ValueError:
+                logging.error("Illegal history depth specified: %s", options[depth_name])
+                depth = cls.DEFAULT_DEPTH
+
+        return cls(patterns, depth)
+
+    def matches(self, path):
+        """
+        Determine if the history of a path is to be recorded.
+
+        :param path: path of the leaf
+        :return: True if the path matches one of the patterns
+        """
+        match = self._matches.get(path)
+        if match is None:
+            match = self._matches[path] = any(
+                fnmatch.fnmatchcase(path, pattern) for pattern in self.patterns
+            )
+        return match
+
+    def refresh_paths(self):
+        """
+        Get the paths to be read to sample all the leaves matching the patterns.
+
+        Each pattern is truncated before its first element containing a wildcard, and paths
+        covered by a shorter path are removed, with an empty path covering the whole tree.
+
+        :return: sorted list of paths
+        """
+        paths = set()
+        for pattern in self.patterns:
+            elems = []
+            for elem in pattern.split('/'):
+                if any(char in elem for char in '*?['):
+                    break
+                elems.append(elem)
+            paths.add('/'.join(elems))
+
+        return sorted(
+            path for path in paths
+            if not any(
+                other != path and (not other or path.startswith(other + '/')) for other in paths
+            )
+        )
+
+    def record(self, path, value, timestamp=None):
+        """
+        Record a sample of a leaf, if its path matches one of the patterns.
+
+        :param path: path of the leaf
+        :param value: value of the leaf
+        :param timestamp: timestamp of the sample, defaulting to the current time
+        """
+        path = path.strip('/')
+        if not isinstance(value, (int, float)) or not self.matches(path):
+            return
+
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            buffer = self.buffers.get(path)
+            if buffer is None:
+                buffer = self.buffers[path] = HistoryBuffer(self.depth)
+            buffer.append(timestamp, value)
+
+    def record_tree(self, path, values, timestamp=None):
+        """
+        Record samples of all the leaves in a tree of values.
+
+        :param path: path of the tree
+        :param values: nested dict of values
+        :param timestamp: timestamp of the samples, defaulting to the current time
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        path = path.strip('/')
+        for key, value in values.items():
+            leaf_path = path + '/' + key if path else key
+            if isinstance(value, dict):
+                self.record_tree(leaf_path, value, timestamp)
+            else:
+                self.record(leaf_path, value, timestamp)
+
+    def get(self, path, start=None, end=None, max_points=None):
+        """
+        Get the history of a leaf, or the list of leaves with history for an empty path.
+
+        :param path: path of the leaf
+        :param start: start of the time range, or None for the oldest sample
+        :param end: end of the time range, or None for the newest sample
+        :param max_points: maximum number of points to return, or None for no decimation
+        :return: dict of the history of the leaf
+        """
+        path = path.strip('/')
+        with self._lock:
+            if not path:
+                return {'paths': sorted(self.buffers)}
+            buffer = self.buffers.get(path)
+            if buffer is None:
+                raise ParameterTreeError("No history for path: {}".format(path))
+            return {path.rsplit('/', 1)[-1]: buffer.query(start, end, max_points)}
+
+
+def history_query_args(request):
+    """
+    Resolve the history query arguments of a request.
+
+    The start and end of the time range and the maximum number of points are taken from the
+    start, end and points query arguments of the request, if present.
+
+    :param request: HTTPServerRequest or equivalent from client
+    :return: dict of keyword arguments for ParameterHistory.get
+    """
+    arguments = getattr(request, 'query_arguments', {})
+    query_args = {}
+    for (name, arg_type, kwarg) in (
+        ('start', float, 'start'), ('end', float, 'end'), ('points', int, 'max_points')
+    ):
+        if arguments.get(name):
+            value = arguments[name][-1]
+            if isinstance(value, bytes):
+                value = value.decode()
+            query_args[kwarg] = arg_type(value)
+    return query_args
@@ -1,25 +1,35 @@
 import logging
 from concurrent import futures
+from functools import partial
+import threading
 import time
 from odin.adapters.parameter_tree import ParameterTree, ParameterTreeError
-from odin.adapters.adapter import ApiAdapter, ApiAdapterRequest, ApiAdapterResponse, request_types, response_types
+from odin.adapters.adapter import ApiAdapter, ApiAdapterRequest, ApiAdapterResponse, request_types, response_types, wants_metadata
 from odin.util import decode_request_body
 from tornado.concurrent import run_on_executor
+from prototype_DAQ.history import ParameterHistory, history_query_args
+from prototype_DAQ.profiling import profiler
+from prototype_DAQ.replay import ReplayFile, ReplayError
 
 class DummyAdapter(ApiAdapter):
     def __init__(self, **kwargs):
         self.test_value = 123
         super(DummyAdapter, self).__init__(**kwargs)
-        self.dummyController = Dummy()
+        self.dummyController = Dummy(ParameterHistory.from_options(self.options))
         logging.debug('DummyAdapter loaded')
 
     @response_types('application/json', default='application/json')
     def get(self, path, request):
         """Handle an HTTP GET request."""
         try:
-            response = self.dummyController.get(path, False)
+            if path.split('/', 1)[0] == 'history':
+                response = self.dummyController.get_history(
+                    path.split('/', 1)[1] if '/' in path else '', **history_query_args(request)
+                )
+            else:
+                response = self.dummyController.get(path, wants_metadata(request))
             status_code = 200
-        except ParameterTreeError as param_error:
+        except (ParameterTreeError, ValueError) as param_error:
             response = {'error': str(param_error)}
             status_code = 400
 
@@ -45,16 +55,57 @@ class DummyAdapter(ApiAdapter):
 
 class Dummy():
     executor = futures.ThreadPoolExecutor(max_workers=1)
+    replay_executor = futures.ThreadPoolExecutor(max_workers=1)
 
-    def __init__(self):
+    def __init__(self, history=None):
+        self.history = history
         self.background_task_enable = True
         self.background_task_interval = 1
         self.background_thread_counter = 0
 
+        # Replay settings and status, frames replayed from the file are passed to each of the
+        # frame consumers in turn
+        self.replay_enable = False
+        self.replay_file_name = ""
+        self.replay_dataset = ""
+        self.replay_frame_size = 0
+        self.replay_header_size = 0
+        self.replay_rate = 0.0
+        self.replay_speed = 1.0
+        self.replay_loop = False
+        self.replay_start_offset = 0
+        self.replay_num_frames = 0
+        self.replay_frames_read = 0
+        self.replay_read_rate = 0.0
+        self.replay_frame_rate = 0.0
+        self.replay_error = ""
+        self.frame_consumers = []
+
+        # Events signalling the current replay run to stop and indicating that it has finished, a
+        # new pair is created for each run
+        self._replay_stop = None
+        self._replay_done = None
+
         self.param_tree = ParameterTree({
             'background_task_counter': (lambda: self.background_thread_counter, None),
             'enable': (lambda: self.background_task_enable, self.set_task_enable),
-            'interval': (lambda: self.background_task_interval, self.set_task_interval)
+            'interval': (lambda: self.background_task_interval, self.set_task_interval),
+            'replay': {
+                'enable': (lambda: self.replay_enable, self.set_replay_enable),
+                'file': (lambda: self.replay_file_name, partial(self.set_replay_option, 'file_name', str)),
+                'dataset': (lambda: self.replay_dataset, partial(self.set_replay_option, 'dataset', str)),
+                'frame_size': (lambda: self.replay_frame_size, partial(self.set_replay_option, 'frame_size', int)),
+                'header_size': (lambda: self.replay_header_size, partial(self.set_replay_option, 'header_size', int)),
+                'rate': (lambda: self.replay_rate, partial(self.set_replay_option, 'rate', float)),
+                'speed': (lambda: self.replay_speed, partial(self.set_replay_option, 'speed', float)),
+                'loop': (lambda: self.replay_loop, partial(self.set_replay_option, 'loop', bool)),
+                'start_offset': (lambda: self.replay_start_offset, partial(self.set_replay_option, 'start_offset', int)),
+                'num_frames': (lambda: self.replay_num_frames, None),
+                'frames_read': (lambda: self.replay_frames_read, None),
+                'read_rate': (lambda: self.replay_read_rate, None),
+                'frame_rate': (lambda: self.replay_frame_rate, None),
+                'error': (lambda: self.replay_error, None),
+            }
         })
 
         if self.background_task_enable:
@@ -73,6 +124,60 @@ class Dummy():
             else:
                 self.stop_background_tasks()
 
+    def set_replay_option(self, name, option_type, value):
+        """Set a replay option, taking effect the next time replay is enabled."""
+        setattr(self, 'replay_' + name, option_type(value))
+
+    def set_replay_enable(self, enable):
+        """Start or stop replaying frames from the replay file."""
+        enable = bool(enable)
+        if enable == self.replay_enable:
+            return
+
+        if not enable:
+            self.replay_enable = False
+            if self._replay_stop is not None:
+                self._replay_stop.set()
+            return
+
+        # Make sure any previous run has stopped and released its file before starting a new one.
+        # Waiting for it here would block the server, so ask it to stop and reject the request,
+        # leaving the client to retry
+        if self._replay_done is not None and not self._replay_done.is_set():
+            self._replay_stop.set()
+            self.replay_error = "Previous replay run is stopping, retry"
+            raise ParameterTreeError(self.replay_error)
+
+        try:
+            replay_file = ReplayFile(
+                self.replay_file_name, self.replay_frame_size, self.replay_header_size,
+                self.replay_dataset
+            )
+        except ReplayError as replay_error:
+            self.replay_error = str(replay_error)
+            raise ParameterTreeError(self.replay_error)
+
+        if not 0 <= self.replay_start_offset < replay_file.num_frames:
+            replay_file.close()
+            self.replay_error = "Replay start offset {} outside file of {} frames".format(
+                self.replay_start_offset, replay_file.num_frames
+            )
+            raise ParameterTreeError(self.replay_error)
+
+        self.replay_error = ""
+        self.replay_num_frames = replay_file.num_frames
+        self.replay_frames_read = 0
+        self._replay_stop = threading.Event()
+        self._replay_done = threading.Event()
+        self.replay_enable = True
+        self.replay_task(replay_file, self._replay_stop, self._replay_done)
+
+    def update_replay_rates(self, frames, elapsed, frame_size):
+        """Update the replay frame rate and read rate in MB/s from the frames read in a window."""
+        if elapsed > 0:
+            self.replay_frame_rate = frames / elapsed
+            self.replay_read_rate = self.replay_frame_rate * frame_size / 1.0e6
+
     def start_background_tasks(self):
         """Start the background tasks."""
         self.background_task_enable = True
@@ -90,19 +195,92 @@ class Dummy():
         """Set a parameter in the parameter tree."""
         return self.param_tree.set(path, value)
        
+    def get_history(self, path, **kwargs):
+        """Get the recorded history of a parameter in the parameter tree."""
+        if self.history is None:
+            raise ParameterTreeError("Parameter history is not enabled")
+        return self.history.get(path, **kwargs)
+
     def cleanup(self):
         """Clean up the Dummy instance."""
         logging.debug("Starting cleanup of Dummy adapter.")
         self.stop_background_tasks()
+        self.set_replay_enable(False)
 
     @run_on_executor
     def background_thread_task(self):
         while self.background_task_enable:
             time.sleep(self.background_task_interval)
-            if self.background_thread_counter < 10 or self.background_thread_counter % 20 == 0:
-                logging.debug(
-                    "Background thread task running, count = %d", self.background_thread_counter
-                )
-            self.background_thread_counter += 1
+            with profiler.span('dummy.background_tick'):
+                if self.background_thread_counter < 10 or self.background_thread_counter % 20 == 0:
+                    logging.debug(
+                        "Background thread task running, count = %d", self.background_thread_counter
+                    )
+                self.background_thread_counter += 1
+
+                if self.history is not None:
+                    self.history.record_tree('', self.param_tree.get(''))
 
         logging.debug("Background thread task stopping")
+
+    @run_on_executor(executor='replay_executor')
+    def replay_task(self, replay_file, stop, done):
+        """
+        Replay frames from the memory-mapped replay file.
+
+        Frames are read at the replay rate scaled by the speed, or as fast as possible if the rate
+        is zero, starting from the start offset and optionally looping at the end of the file. The
+        sustained read and frame rates are updated every second. The run ends when its stop event
+        is set, and sets its done event once the file is closed.
+        """
+        logging.debug(
+            "Replaying %d frames of %d bytes from %s",
+            replay_file.num_frames, replay_file.frame_size, replay_file.file_name
+        )
+        rate = self.replay_rate * self.replay_speed
+        period = 1.0 / rate if rate > 0 else 0.0
+        index = self.replay_start_offset
+        next_frame_time = time.monotonic()
+        window_start = next_frame_time
+        window_frames = 0
+
+        try:
+            while not stop.is_set():
+                if period:
+                    delay = next_frame_time - time.monotonic()
+                    if delay > 0 and stop.wait(delay):
+                        break
+                    next_frame_time += period
+
+                with profiler.span('dummy.replay_frame'):
+                    frame = replay_file.read_frame(index)
+                    for consumer in self.frame_consumers:
+                        consumer(frame)
+
+                self.replay_frames_read += 1
+                window_frames += 1
+                index += 1
+                if index >= replay_file.num_frames:
+                    if not self.replay_loop:
+                        break
+                    index = self.replay_start_offset
+
+                now = time.monotonic()
+                if now - window_start >= 1.0:
+                    self.update_replay_rates(window_frames, now - window_start, replay_file.frame_size)
+                    window_start = now
+                    window_frames = 0
+
+            # Update the rates with any frames read since the last full window
+            if window_frames:
+                self.update_replay_rates(
+                    window_frames, time.monotonic() - window_start, replay_file.frame_size
+                )
+        finally:
+            replay_file.close()
+            # Only clear the enable flag if it has not since been claimed by a new run
+            if self._replay_stop is stop:
+                self.replay_enable = False
+            done.set()
+
+        logging.debug("Replay task stopping after %d frames", self.replay_frames_read)
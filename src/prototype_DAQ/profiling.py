@@ -0,0 +1,194 @@
+"""
+Profiling support for the prototype DAQ adapters.
+
+This module implements a lightweight profiler that can be enabled at runtime, e.g. through the
+controller parameter tree. Code is instrumented with named timing spans, which are aggregated into
+per-span statistics while the profiler is enabled and cost only a flag check when it is not. A
+sampling profiler can also be run for a fixed duration, producing a dump of the sampled stacks in
+the collapsed format used by flame graph tools.
+
+Josh Harris, STFC Detector Systems Software Group.
+"""
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from odin.adapters.parameter_tree import ParameterTreeError
+
+
+class _NullSpan(object):
+    """Timing span used when the profiler is disabled, doing nothing on entry and exit."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    """Timing span recording its duration with the profiler on exit."""
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start_time = None
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.record(self.name, time.perf_counter() - self.start_time)
+        return False
+
+
+class Profiler(object):
+    """
+    Profiler class.
+
+    This class aggregates the durations of named timing spans while enabled and runs the sampling
+    profiler on demand.
+    """
+
+    def __init__(self):
+        """Initialise the Profiler object."""
+        self.enabled = False
+        self.sampling = False
+        self.sample_duration = 0.0
+        self.samples = ''
+        self._spans = {}
+        self._lock = threading.Lock()
+
+    def enable(self, enable):
+        """
+        Enable or disable the recording of timing spans.
+
+        :param enable: flag indicating if spans are to be recorded
+        """
+        self.enabled = bool(enable)
+        logging.debug("Profiler %s", 'enabled' if self.enabled else 'disabled')
+
+    def span(self, name):
+        """
+        Create a timing span context manager.
+
+        :param name: name of the span
+        :return: a context manager recording the duration of the span if the profiler is enabled
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def record(self, name, duration):
+        """
+        Record the duration of a span.
+
+        :param name: name of the span
+        :param duration: duration of the span in seconds
+        """
+        with self._lock:
+            stats = self._spans.get(name)
+            if stats is None:
+                self._spans[name] = [1, duration, duration]
+            else:
+                stats[0] += 1
+                stats[1] += duration
+                stats[2] = max(stats[2], duration)
+
+    def span_stats(self):
+        """
+        Get the aggregated statistics of the recorded spans.
+
+        :return: dict of count and total, mean and max duration in seconds of each span
+        """
+        with self._lock:
+            return dict(
+                (name, {
+                    'count': count,
+                    'total': total,
+                    'mean': total / count,
+                    'max': max_duration,
+                })
+                for (name, (count, total, max_duration)) in self._spans.items()
+            )
+
+    def reset(self):
+        """Reset the recorded span statistics and sampled stacks."""
+        with self._lock:
+            self._spans = {}
+        self.samples = ''
+
+    def start_sampling(self, duration, interval=0.005):
+        """
+        Start the sampling profiler.
+
+        The stacks of all threads are sampled at the specified interval for the specified duration
+        in a background thread, after which the collapsed stack dump is available in the samples
+        attribute. Requests to start sampling while already sampling are ignored.
+
+        :param duration: duration to sample for in seconds
+        :param interval: interval between samples in seconds
+        """
+        try:
+            duration = float(duration)
+        except (TypeError, ValueError):
+            raise ParameterTreeError("Illegal sampling duration specified: {}".format(duration))
+        if duration <= 0:
+            raise ParameterTreeError("Sampling duration must be positive: {}".format(duration))
+
+        if self.sampling:
+            logging.debug("Profiler is already sampling")
+            return
+
+        self.sampling = True
+        self.sample_duration = duration
+        sample_thread = threading.Thread(
+            target=self._sample, args=(self.sample_duration, interval), name='profiler_sampler',
+            daemon=True
+        )
+        sample_thread.start()
+
+    def _sample(self, duration, interval):
+        """
+        Sample the stacks of all threads, building the collapsed stack dump.
+
+        :param duration: duration to sample for in seconds
+        :param interval: interval between samples in seconds
+        """
+        stacks = Counter()
+        sample_thread_id = threading.get_ident()
+        end_time = time.monotonic() + duration
+
+        try:
+            while time.monotonic() < end_time:
+                for (thread_id, frame) in sys._current_frames().items():
+                    if thread_id == sample_thread_id:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append('{} ({}:{})'.format(
+                            code.co_name, os.path.basename(code.co_filename), code.co_firstlineno
+                        ))
+                        frame = frame.f_back
+                    stacks[';'.join(reversed(stack))] += 1
+                time.sleep(interval)
+
+            self.samples = '\n'.join(
+                '{} {}'.format(stack, count) for (stack, count) in stacks.most_common()
+            )
+            logging.debug("Profiler sampled %d distinct stacks", len(stacks))
+        finally:
+            # Always clear the sampling flag, so that a failure does not block further sampling
+            self.sampling = False
+
+
+# Profiler instance shared by the instrumented modules
+profiler = Profiler()
@@ -2,18 +2,27 @@
 Proxy adapter for use in odin-control.
 
 This module implements a simple proxy adapter, allowing requests to be proxied to
-one or more remote HTTP resources, typically further odin-control instances.
+one or more remote HTTP resources, typically further odin-control instances. Requests to the
+remote resources are made with the blocking Requests library, so the adapter is asynchronous,
+handling client requests on an executor rather than the server IOLoop. This allows concurrent
+client requests to overlap, sharing in-flight reads and being scheduled by the proxy targets.
 
 Tim Nicholls, Ashley Neaves STFC Detector Systems Software Group.
 """
+import logging
+import threading
+import time
+from concurrent import futures
 import requests
-from odin.util import decode_request_body
+from odin.util import decode_request_body, run_in_executor
 from odin.adapters.adapter import (
-    ApiAdapter, ApiAdapterResponse,
+    ApiAdapterResponse,
     request_types, response_types, wants_metadata
 )
+from odin.adapters.async_adapter import AsyncApiAdapter
 #from odin.adapters.base_proxy import BaseProxyTarget, BaseProxyAdapter
 from prototype_DAQ.base_proxy import BaseProxyTarget, BaseProxyAdapter
+from prototype_DAQ.profiling import profiler
 
 #node_1 = http://192.168.0.157:8888/api/0.1/detector/
 
@@ -27,7 +36,10 @@ class ProxyTarget(BaseProxyTarget):
     status information for use in the ProxyAdapter.
     """
 
-    def __init__(self, name, url, request_timeout):
+    # Number of threads used by each target to send the attempts of hedged requests
+    HEDGE_THREADS = 16
+
+    def __init__(self, name, url, request_timeout, **kwargs):
         """
         Initialise the ProxyTarget object.
 
@@ -37,9 +49,17 @@ class ProxyTarget(BaseProxyTarget):
         :param name: name of the proxy target
         :param url: URL of the remote target
         :param request_timeout: request timeout in seconds
+        :param kwargs: keyword arguments specifying optional target behaviour
         """
         # Initialise the base class
-        super(ProxyTarget, self).__init__(name, url, request_timeout)
+        super(ProxyTarget, self).__init__(name, url, request_timeout, **kwargs)
+
+        # Create the executor used to send the attempts of hedged requests concurrently. Each
+        # target has its own executor so that hedged requests to one target do not queue behind
+        # those to others
+        self.hedge_executor = None
+        if self.hedged_requests:
+            self.hedge_executor = futures.ThreadPoolExecutor(max_workers=self.HEDGE_THREADS)
 
         # Initialise the data and metadata trees from the remote target
         self.remote_get()
@@ -50,36 +70,104 @@ class ProxyTarget(BaseProxyTarget):
         Send a request to the remote target using the Requests library, handling the response
         and updating target data accordingly.
 
+        If the request specifies a hedge delay, a second attempt is sent once the first has been
+        outstanding for that long, and the first successful response of the two is used.
+
         :param request: HTTP request dict to transmit to target
         :param path: path of data being updated
         :param get_metadata: flag indicating if metadata is to be requested
         """
+        hedge_after = request.get('hedge_after')
+        if hedge_after is None or self.hedge_executor is None:
+            response = self._fetch(request)
+        else:
+            response = self._fetch_hedged(request, hedge_after)
+
+        # Process the response from the target, updating data as appropriate
+        self._process_response(response, path, get_metadata)
+
+    def _fetch(self, request):
+        """
+        Fetch a response to a request from the remote target, recording the latency of GET
+        requests for adaptive timeouts and hedging.
+
+        :param request: HTTP request dict to transmit to target
+        :return: HTTP response from the target, or the exception raised if the request failed
+        """
         # Send the request to the remote target, handling any exceptions that occur
+        start_time = time.time()
+        record_latency = request['method'] == 'GET'
         try:
             # Use the requests.request method to send the request
-            response = requests.request(
-                method=request['method'], 
-                url=request['url'],
-                headers=request.get('headers'),# Safely get access to optional params
-                timeout=request.get('timeout'), 
-                data=request.get('data') 
-            )
+            with profiler.span('proxy.send'):
+                response = requests.request(
+                    method=request['method'], 
+                    url=request['url'],
+                    headers=request.get('headers'),# Safely get access to optional params
+                    timeout=request.get('timeout'), 
+                    data=request.get('data') 
+                )
         except Exception as fetch_exception:
-            # Set the response to the exception so it can be handled during response resolution 
-            response = fetch_exception
+            # Record the latency of timed out requests so that adaptive timeouts can grow to
+            # accommodate the target, then return the exception so it can be handled during
+            # response resolution
+            if record_latency and isinstance(fetch_exception, requests.Timeout):
+                self.latency.record(time.time() - start_time)
+            return fetch_exception
 
-        # Process the response from the target, updating data as appropriate
-        self._process_response(response, path, get_metadata)
+        if record_latency:
+            self.latency.record(time.time() - start_time)
+        return response
 
+    def _fetch_hedged(self, request, hedge_after):
+        """
+        Fetch a response to a request from the remote target, hedging slow requests.
+
+        The hedge delay is measured from when the first attempt starts, so that attempts queued
+        behind others on a busy executor are not hedged.
 
-class ProxyAdapter(ApiAdapter, BaseProxyAdapter):
+        :param request: HTTP request dict to transmit to target
+        :param hedge_after: delay in seconds after which a second attempt is sent
+        :return: HTTP response from the target, or the exception raised if the request failed
+        """
+        started = threading.Event()
+
+        def fetch_primary():
+            started.set()
+            return self._fetch(request)
+
+        primary = self.hedge_executor.submit(fetch_primary)
+        started.wait()
+        try:
+            return primary.result(timeout=hedge_after)
+        except futures.TimeoutError:
+            pass
+
+        # The primary attempt has exceeded the hedge delay, so send a second attempt and use the
+        # first successful response
+        self.hedged_count += 1
+        hedge = self.hedge_executor.submit(self._fetch, request)
+        for attempt in futures.as_completed([primary, hedge]):
+            response = attempt.result()
+            if not isinstance(response, Exception):
+                break
+
+        return response
+
+
+class ProxyAdapter(AsyncApiAdapter, BaseProxyAdapter):
     """
     Proxy adapter class for odin-control.
 
     This class implements a proxy adapter, allowing odin-control to forward requests to
-    other HTTP services.
+    other HTTP services. Client requests are handled on the request executor of the adapter, the
+    size of which is specified by the request_threads option. Synchronous equivalents of the
+    request handlers are provided for inter-adapter communication.
     """
 
+    REQUEST_THREADS_CONFIG_NAME = 'request_threads'
+    DEFAULT_REQUEST_THREADS = 16
+
     def __init__(self, **kwargs):
         """
         Initialise the ProxyAdapter.
@@ -93,14 +181,50 @@ class ProxyAdapter(ApiAdapter, BaseProxyAdapter):
         # Initialise the base class
         super(ProxyAdapter, self).__init__(**kwargs)
 
+        # Create the executor on which client requests are handled, sized from the options
+        request_threads = self.DEFAULT_REQUEST_THREADS
+        if self.REQUEST_THREADS_CONFIG_NAME in self.options:
+            try:
+                request_threads = max(1, int(self.options[self.REQUEST_THREADS_CONFIG_NAME]))
+            except ValueError:
+                logging.error(
+                    "Illegal number of request threads specified for proxy adapter: %s",
+                    self.options[self.REQUEST_THREADS_CONFIG_NAME]
+                )
+        self.request_executor = futures.ThreadPoolExecutor(max_workers=request_threads)
+
         # Initialise the proxy targets and parameter trees
         self.initialise_proxy(ProxyTarget)
 
-    @response_types('application/json', default='application/json')
-    def get(self, path, request):
+    async def get(self, path, request):
         """
         Handle an HTTP GET request.
 
+        This async method handles an HTTP GET request on the request executor of the adapter.
+
+        :param path: URI path of request
+        :param request: HTTP request object
+        :return: an ApiAdapterResponse object containing the appropriate response
+        """
+        return await run_in_executor(self.request_executor, self.get_sync, path, request)
+
+    async def put(self, path, request):
+        """
+        Handle an HTTP PUT request.
+
+        This async method handles an HTTP PUT request on the request executor of the adapter.
+
+        :param path: URI path of request
+        :param request: HTTP request object
+        :return: an ApiAdapterResponse object containing the appropriate response
+        """
+        return await run_in_executor(self.request_executor, self.put_sync, path, request)
+
+    @response_types('application/json', default='application/json')
+    def get_sync(self, path, request):
+        """
+        Handle an HTTP GET request synchronously.
+
         This method handles an HTTP GET request, returning a JSON response. The request is
         passed to the adapter proxy and resolved into responses from the requested proxy targets.
 
@@ -108,18 +232,28 @@ class ProxyAdapter(ApiAdapter, BaseProxyAdapter):
         :param request: HTTP request object
         :return: an ApiAdapterResponse object containing the appropriate response
         """
+        # Resolve requests for parameter history from the history store
+        path_elem, history_path = self._resolve_path(path)
+        if path_elem == self.HISTORY_PATH:
+            (response, status_code) = self._resolve_history(history_path, request)
+            return ApiAdapterResponse(response, status_code=status_code)
+
         get_metadata = wants_metadata(request)
 
-        self.proxy_get(path, get_metadata)
+        sent = self.proxy_get(path, get_metadata)
         (response, status_code) = self._resolve_response(path, get_metadata)
 
+        # Mark responses including cached data from targets whose reads were shed as stale
+        if status_code == 200 and not all(sent):
+            status_code = self.STALE_STATUS_CODE
+
         return ApiAdapterResponse(response, status_code=status_code)
 
     @request_types("application/json", "application/vnd.odin-native")
     @response_types('application/json', default='application/json')
-    def put(self, path, request):
+    def put_sync(self, path, request):
         """
-        Handle an HTTP PUT request.
+        Handle an HTTP PUT request synchronously.
 
         This method handles an HTTP PUT request, returning a JSON response. The request is
         passed to the adapter proxy to set data on the remote targets and resolved into responses
@@ -137,7 +271,22 @@ class ProxyAdapter(ApiAdapter, BaseProxyAdapter):
             response = {'error': 'Failed to decode PUT request body: {}'.format(str(type_val_err))}
             status_code = 415
         else:
-            self.proxy_set(path, body)
+            synchronous = request.headers.get(self.SYNC_WRITE_HEADER, '').lower() in ('1', 'true')
+            self.proxy_set(path, body, synchronous)
             (response, status_code) = self._resolve_response(path)
 
         return ApiAdapterResponse(response, status_code=status_code)
+
+    async def cleanup(self):
+        """
+        Clean up the state of the adapter.
+
+        This method stops any periodic history refresh and flushes any writes pending in the
+        write-behind queues of the proxy targets.
+        """
+        self.stop_history_refresh()
+        self.flush_writes()
+        self.request_executor.shutdown()
+        for target in self.targets:
+            if target.hedge_executor is not None:
+                target.hedge_executor.shutdown()
@@ -0,0 +1,125 @@
+"""
+Recorded data replay classes for the prototype DAQ adapters.
+
+This module implements memory-mapped access to large recorded detector data files, allowing
+frames to be streamed from them without loading the file into memory. Raw files are treated as an
+optional fixed-size header followed by fixed-size frames. HDF5 files are supported for contiguous
+(i.e. uncompressed, unchunked) datasets, whose first dimension is the frame index, by mapping the
+region of the file holding the dataset. HDF5 support requires the optional h5py package.
+
+Josh Harris, STFC Detector Systems Software Group.
+"""
+import mmap
+import os
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+class ReplayError(Exception):
+    """Simple exception class for errors opening or reading a replay file."""
+    pass
+
+
+class ReplayFile(object):
+    """
+    Memory-mapped replay file.
+
+    This class maps a recorded data file into memory read-only and copies frames from it into a
+    reusable frame buffer on demand, so that only the pages of the frames being read are resident.
+    """
+
+    def __init__(self, file_name, frame_size=0, header_size=0, dataset=''):
+        """
+        Initialise the ReplayFile object, mapping the file into memory.
+
+        :param file_name: path of the recorded data file
+        :param frame_size: size of each frame in bytes, for raw files
+        :param header_size: size of the header preceding the first frame in bytes, for raw files
+        :param dataset: name of the frame dataset, for HDF5 files
+        """
+        self.file_name = file_name
+
+        if dataset:
+            (self.header_size, self.frame_size, self.num_frames) = \
+                self._resolve_dataset(file_name, dataset)
+        else:
+            if frame_size <= 0:
+                raise ReplayError("Frame size must be specified for raw replay files")
+            self.header_size = header_size
+            self.frame_size = frame_size
+            try:
+                file_size = os.path.getsize(file_name)
+            except OSError as os_error:
+                raise ReplayError("Failed to open replay file: {}".format(os_error))
+            self.num_frames = max(0, (file_size - header_size) // frame_size)
+
+        if self.num_frames == 0:
+            raise ReplayError("Replay file {} contains no frames".format(file_name))
+
+        try:
+            self._file = open(file_name, 'rb')
+        except OSError as os_error:
+            raise ReplayError("Failed to open replay file: {}".format(os_error))
+
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as map_error:
+            self._file.close()
+            raise ReplayError("Failed to map replay file: {}".format(map_error))
+
+        # Advise the kernel that the mapping is read sequentially, where supported
+        if hasattr(self._mmap, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            self._mmap.madvise(mmap.MADV_SEQUENTIAL)
+
+        self._view = memoryview(self._mmap)
+        self.frame_buffer = bytearray(self.frame_size)
+
+    @staticmethod
+    def _resolve_dataset(file_name, dataset):
+        """
+        Resolve the location and layout of a frame dataset in an HDF5 file.
+
+        :param file_name: path of the HDF5 file
+        :param dataset: name of the frame dataset
+        :return: tuple of offset of the dataset in the file, frame size and number of frames
+        """
+        if h5py is None:
+            raise ReplayError("HDF5 replay requires the h5py package")
+
+        try:
+            with h5py.File(file_name, 'r') as h5_file:
+                frames = h5_file[dataset]
+                offset = frames.id.get_offset()
+                frame_size = frames.dtype.itemsize
+                for dim in frames.shape[1:]:
+                    frame_size *= dim
+                num_frames = frames.shape[0] if frames.shape else 0
+        except (OSError, KeyError) as h5_error:
+            raise ReplayError("Failed to open replay dataset: {}".format(h5_error))
+
+        if offset is None:
+            raise ReplayError(
+                "Replay dataset {} is not stored contiguously and cannot be mapped".format(dataset)
+            )
+
+        return (offset, frame_size, num_frames)
+
+    def read_frame(self, index):
+        """
+        Read a frame from the file into the frame buffer.
+
+        :param index: index of the frame to read
+        :return: memoryview of the frame buffer
+        """
+        start = self.header_size + index * self.frame_size
+        self.frame_buffer[:] = self._view[start:start + self.frame_size]
+        return memoryview(self.frame_buffer)
+
+    def close(self):
+        """Unmap and close the file."""
+        self._view.release()
+        self._mmap.close()
+        self._file.close()
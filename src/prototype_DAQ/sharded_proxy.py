@@ -0,0 +1,662 @@
+"""
+Sharded proxy adapter for use in odin-control.
+
+This module implements a proxy adapter that splits its proxy targets across a number of worker
+processes, or shards. Each shard owns the proxy targets assigned to it, handling the requests
+to those targets and the decoding of their responses, and publishes the resulting status and data
+back to the adapter over a pipe. The adapter serves requests from its view of the target state,
+allowing request handling to scale across cores as the number of targets grows.
+
+Commands sent to a shard are tagged with a sequence number and handled concurrently by the worker,
+which replies to each as it completes. Client requests handled on different threads of the adapter
+request executor therefore overlap, both across shards and within a shard, where they are
+coalesced and scheduled by the proxy targets as in the unsharded adapter. If a worker process
+exits, it is restarted by the next request to the shard. Writes pending in the write-behind queues
+of an exited worker are lost.
+
+Shards only publish state in reply to commands from the adapter. Writes flushed by the write-behind
+timer in a worker are therefore not published when they complete: the view shows the queued values
+immediately, but the response to the flush, including any error, is only reflected in the view by
+the next request to the target or an explicit flush of the adapter.
+
+Josh Harris, STFC Detector Systems Software Group.
+"""
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent import futures
+from functools import partial
+
+from odin.adapters.parameter_tree import ParameterTree, ParameterTreeError
+
+from prototype_DAQ.base_proxy import BaseProxyTarget, ProxyDataTree
+from prototype_DAQ.proxy import ProxyAdapter
+
+
+class ShardError(Exception):
+    """Simple exception class for failures of a proxy shard."""
+    pass
+
+
+class ShardTargetView(object):
+    """
+    Sharded proxy target view class.
+
+    This class implements the adapter view of a proxy target owned by a shard worker process. It
+    presents the same data, metadata and status parameter trees as a proxy target, which are
+    updated with the state published by the shard.
+    """
+
+    # Default values of the status published by the shard for the target, from which the leaves
+    # of the status parameter tree are built
+    STATUS_DEFAULTS = {
+        'url': '',
+        'status_code': 0,
+        'error': 'OK',
+        'last_update': 'unknown',
+        'coalesced': 0,
+        'pending_writes': 0,
+        'failed_writes': 0,
+        'last_flush_error': '',
+        'timeout': None,
+        'latency_p95': None,
+        'hedged': 0,
+        'stale': {'data': [], 'metadata': []},
+        'scheduler': {
+            'queue_depth': {'control': 0, 'status': 0, 'bulk': 0},
+            'shed': {'control': 0, 'status': 0, 'bulk': 0},
+        },
+    }
+
+    def __init__(self, name, url, shard):
+        """
+        Initialise the ShardTargetView object.
+
+        :param name: name of the proxy target
+        :param url: URL of the remote target
+        :param shard: shard owning the proxy target
+        """
+        self.name = name
+        self.url = url
+        self.shard = shard
+
+        # Initialise default state
+        self.status = {'url': url}
+        self.history = None
+        self.data_tree = ProxyDataTree()
+        self.meta_tree = ProxyDataTree()
+        self.data = self.data_tree.root
+        self.metadata = self.meta_tree.root
+
+        # Build parameter tree representations of the proxy target status, data and metadata
+        self.status_param_tree = ParameterTree(self._status_leaves(self.STATUS_DEFAULTS))
+        self.data_param_tree = ParameterTree((lambda: self.data_tree.get(''), None))
+        self.meta_param_tree = ParameterTree((lambda: self.meta_tree.get(''), None))
+
+    def _status_leaves(self, defaults, keys=()):
+        """
+        Build the leaves of the status parameter tree, each reading the published status.
+
+        :param defaults: dict of default status values at this level of the tree
+        :param keys: tuple of keys of this level of the tree
+        :return: dict of status parameter tree leaves
+        """
+        return dict(
+            (key, self._status_leaves(value, keys + (key,)) if isinstance(value, dict)
+             else (partial(self._status_value, keys + (key,), value), None))
+            for (key, value) in defaults.items()
+        )
+
+    def _status_value(self, keys, default):
+        """
+        Get a value from the published status.
+
+        :param keys: tuple of keys of the value in the status
+        :param default: default value if not present in the status
+        :return: the status value
+        """
+        value = self.status
+        for key in keys:
+            if not isinstance(value, dict) or key not in value:
+                return default
+            value = value[key]
+        return value
+
+    @property
+    def status_code(self):
+        """Get the HTTP status code of the last request to the target published by the shard."""
+        return self._status_value(('status_code',), self.STATUS_DEFAULTS['status_code'])
+
+    def update(self, state):
+        """
+        Update the view with the target state published by the shard.
+
+        :param state: tuple of status dict, path, metadata flag, data at the path and a flag
+                      indicating if the request was sent to the target or shed
+        """
+        (status, path, get_metadata, values, _) = state
+        self.status = status
+        if values is not None:
+            tree = self.meta_tree if get_metadata else self.data_tree
+            tree.merge(tree.parent_path(path), values)
+
+            # Record the history of the updated data if enabled
+            if not get_metadata and self.history is not None:
+                self.history.record_tree(self.name + '/' + tree.parent_path(path), values)
+
+    def set_error(self, status_code, error_string):
+        """
+        Update the view status to indicate a request to the owning shard has failed.
+
+        :param status_code: HTTP status code describing the failure
+        :param error_string: description of the failure
+        """
+        self.status = dict(self.status, status_code=status_code, error=error_string)
+
+
+class ProxyShard(object):
+    """
+    Proxy shard class.
+
+    This class implements the adapter side of a shard, launching the worker process which owns
+    the proxy targets of the shard and exchanging commands and published state with it over a pipe.
+    Replies are received by a background thread and returned to the sender of each command through
+    a future. If the worker exits, the shard is marked as failed and restarted by the next command.
+    """
+
+    # Parameters of the reply deadline: a command may involve several requests to a target, e.g. a
+    # synchronous write flushing pending writes, so the deadline is scaled from the request timeout.
+    # Targets without a request timeout are bounded by the maximum adaptive timeout. The worker is
+    # also allowed extra time to start up and fetch the initial state of its targets
+    REPLY_TIMEOUT_SCALE = 3.0
+    REPLY_TIMEOUT_MARGIN = 1.0
+    STARTUP_TIMEOUT = 30.0
+
+    # Minimum interval in seconds between restarts of a failed worker
+    RESTART_INTERVAL = 5.0
+
+    # Number of threads used by the worker to handle commands, and to send requests per target
+    COMMAND_THREADS = 16
+    REQUEST_THREADS_PER_TARGET = 4
+
+    def __init__(self, index, proxy_target_cls, target_specs, target_kwargs, context, publish):
+        """
+        Initialise the ProxyShard object.
+
+        :param index: index of the shard
+        :param proxy_target_cls: proxy target class used by the worker to create targets
+        :param target_specs: list of target name and URL pairs owned by the shard
+        :param target_kwargs: dict of keyword arguments used to create the targets
+        :param context: multiprocessing context used to launch the worker
+        :param publish: function called with the shard and the initial target states published
+                        by each launch of the worker
+        """
+        self.index = index
+        self.target_names = [name for (name, _) in target_specs]
+        self.failed = False
+        self.restarts = 0
+        self.ready = None
+
+        request_timeout = target_kwargs.get('request_timeout') or \
+            BaseProxyTarget.ADAPTIVE_TIMEOUT_MAX
+        self.reply_timeout = request_timeout * self.REPLY_TIMEOUT_SCALE + self.REPLY_TIMEOUT_MARGIN
+
+        self._worker_args = (proxy_target_cls, target_specs, target_kwargs)
+        self._context = context
+        self._publish = publish
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._sequence = itertools.count()
+        self._start_time = None
+        self._stopping = False
+        self.conn = None
+        self.process = None
+
+    def start(self):
+        """
+        Launch the shard worker process and the thread receiving its replies.
+
+        The ready attribute is set to a future which completes once the worker has published the
+        initial state of its targets.
+        """
+        self.conn, worker_conn = self._context.Pipe()
+        self.process = self._context.Process(
+            target=_shard_worker,
+            args=(worker_conn,) + self._worker_args,
+            name='proxy_shard_{}'.format(self.index),
+            daemon=True
+        )
+        self.process.start()
+        worker_conn.close()
+
+        self.failed = False
+        self.ready = futures.Future()
+        self._start_time = time.monotonic()
+        receiver = threading.Thread(
+            target=self._receive, args=(self.conn,),
+            name='proxy_shard_{}_receiver'.format(self.index), daemon=True
+        )
+        receiver.start()
+
+    def request(self, command, requests=None):
+        """
+        Send a command to the shard worker, restarting the worker first if it has failed.
+
+        :param command: name of the command
+        :param requests: list of request argument tuples for the command
+        :return: a future resolving to the list of published target states for the requests
+        """
+        future = futures.Future()
+        with self._lock:
+            if self.failed:
+                if time.monotonic() - self._start_time < self.RESTART_INTERVAL:
+                    future.set_exception(ShardError(
+                        "Proxy shard {} failed and is awaiting restart".format(self.index)
+                    ))
+                    return future
+                self._restart()
+
+            sequence = next(self._sequence)
+            self._pending[sequence] = future
+            try:
+                self.conn.send((sequence, command, requests))
+            except (EOFError, OSError) as send_error:
+                del self._pending[sequence]
+                future.set_exception(ShardError(
+                    "Proxy shard {} send failed: {}".format(self.index, repr(send_error))
+                ))
+
+        return future
+
+    def _restart(self):
+        """Restart the failed shard worker process. Called with the shard lock held."""
+        self.restarts += 1
+        logging.warning("Restarting proxy shard %d (restart %d)", self.index, self.restarts)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+        self.start()
+
+    def _receive(self, conn):
+        """
+        Receive replies from the shard worker, resolving the futures of the commands.
+
+        This method runs in a background thread until the worker exits or the pipe is closed, at
+        which point any commands awaiting replies are failed and the shard marked as failed.
+
+        :param conn: pipe connection to the worker
+        """
+        while True:
+            try:
+                (sequence, result, error) = conn.recv()
+            except (EOFError, OSError):
+                break
+
+            # The worker publishes the initial state of its targets without a sequence number
+            if sequence is None:
+                self._publish(self, result)
+                self.ready.set_result(True)
+                continue
+
+            with self._lock:
+                future = self._pending.pop(sequence, None)
+            if future is not None:
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(ShardError(error))
+
+        with self._lock:
+            if conn is not self.conn:
+                return
+            self.failed = True
+            pending = self._pending
+            self._pending = {}
+
+        shard_error = ShardError("Proxy shard {} worker exited".format(self.index))
+        if not self._stopping:
+            logging.error(str(shard_error))
+        for future in pending.values():
+            future.set_exception(shard_error)
+        if not self.ready.done():
+            self.ready.set_exception(shard_error)
+
+    def stop(self):
+        """Stop the shard worker process, flushing any pending writes to its targets."""
+        with self._lock:
+            self._stopping = True
+            try:
+                self.conn.send((None, 'stop', None))
+            except (EOFError, OSError):
+                pass
+        self.process.join(timeout=self.reply_timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+def _shard_worker(conn, proxy_target_cls, target_specs, target_kwargs):
+    """
+    Run a proxy shard worker process.
+
+    This function creates the proxy targets owned by the shard, publishes their initial state and
+    then handles commands received from the adapter until told to stop. Commands are handled
+    concurrently, each replied to with its sequence number once complete, and requests to different
+    targets in the same command are sent concurrently.
+
+    :param conn: pipe connection to the adapter
+    :param proxy_target_cls: proxy target class used to create targets
+    :param target_specs: list of target name and URL pairs owned by the shard
+    :param target_kwargs: dict of keyword arguments used to create the targets
+    """
+    logging.getLogger("urllib3").setLevel(logging.WARNING)
+
+    executor = futures.ThreadPoolExecutor(
+        max_workers=max(1, len(target_specs)) * ProxyShard.REQUEST_THREADS_PER_TARGET
+    )
+    command_executor = futures.ThreadPoolExecutor(max_workers=ProxyShard.COMMAND_THREADS)
+    send_lock = threading.Lock()
+
+    targets = dict(zip(
+        [name for (name, _) in target_specs],
+        executor.map(lambda spec: proxy_target_cls(*spec, **target_kwargs), target_specs)
+    ))
+
+    def reply(sequence, result, error=None):
+        """Send a reply to the adapter."""
+        with send_lock:
+            conn.send((sequence, result, error))
+
+    def target_state(target, path, get_metadata, sent=True):
+        """Build the published state of a target at a path."""
+        tree = target.meta_tree if get_metadata else target.data_tree
+        try:
+            values = tree.get(path)
+        except ParameterTreeError:
+            values = None
+        return (target.status_param_tree.get(''), path, get_metadata, values, sent)
+
+    def handle_get(name, path, get_metadata):
+        """Handle a GET request to a target, returning its published state."""
+        sent = targets[name].remote_get(path, get_metadata)
+        return target_state(targets[name], path, get_metadata, sent)
+
+    def handle_set(name, path, data, synchronous):
+        """Handle a PUT request to a target, returning its published state."""
+        targets[name].remote_set(path, data, synchronous)
+        return target_state(targets[name], path, False)
+
+    def handle_flush(name):
+        """Handle a flush of the write-behind queue of a target, returning its published state."""
+        targets[name].flush_writes()
+        return target_state(targets[name], '', False)
+
+    def run_command(sequence, handler, requests):
+        """Run the requests of a command concurrently and reply with the resulting states."""
+        try:
+            results = [executor.submit(handler, *request) for request in requests]
+            states = [result.result() for result in results]
+        except Exception as command_error:
+            logging.error("Proxy shard command failed: %s", repr(command_error))
+            reply(sequence, None, repr(command_error))
+        else:
+            reply(sequence, states)
+
+    handlers = {'get': handle_get, 'set': handle_set, 'flush': handle_flush}
+
+    # Publish the initial data and metadata of each target
+    reply(None, dict(
+        (name, [target_state(target, '', False), target_state(target, '', True)])
+        for (name, target) in targets.items()
+    ))
+
+    while True:
+        try:
+            (sequence, command, requests) = conn.recv()
+        except EOFError:
+            break
+
+        if command == 'stop':
+            break
+        elif command == 'flush':
+            command_executor.submit(
+                run_command, sequence, handle_flush, [(name,) for name in targets]
+            )
+        elif command in handlers:
+            command_executor.submit(run_command, sequence, handlers[command], requests)
+        else:
+            logging.error("Proxy shard received unknown command: %s", command)
+            reply(sequence, None, "Unknown command: {}".format(command))
+
+    # Complete any commands in progress, then flush pending writes before exiting
+    command_executor.shutdown()
+    for target in targets.values():
+        target.flush_writes()
+    executor.shutdown()
+    conn.close()
+
+
+class ShardedProxyAdapter(ProxyAdapter):
+    """
+    Sharded proxy adapter class for odin-control.
+
+    This class implements a proxy adapter which splits its proxy targets across a number of shard
+    worker processes. The number of shards is specified by the shards option, defaulting to the
+    number of CPU cores, and is limited to the number of targets.
+    """
+
+    SHARDS_CONFIG_NAME = 'shards'
+
+    def initialise_proxy(self, proxy_target_cls):
+        """
+        Initialise the proxy.
+
+        This method initialises the proxy. The adapter options are parsed to determine the list
+        of proxy targets, which are split across the shards. A view of each target is created,
+        then a worker process is launched for each shard and the views initialised with the target
+        state published by the shard.
+
+        :param proxy_target_cls: proxy target class appropriate for the specific implementation
+        """
+        (target_specs, target_kwargs) = self._parse_proxy_options()
+
+        # Resolve the number of shards from the options
+        num_shards = os.cpu_count() or 1
+        if self.SHARDS_CONFIG_NAME in self.options:
+            try:
+                num_shards = int(self.options[self.SHARDS_CONFIG_NAME])
+            except ValueError:
+                logging.error(
+                    "Illegal number of shards specified for proxy adapter: %s",
+                    self.options[self.SHARDS_CONFIG_NAME]
+                )
+        num_shards = max(1, min(num_shards, len(target_specs)))
+
+        # Create the shards, assigning targets to them in turn. Workers are spawned rather than
+        # forked to avoid inheriting the state of the running server
+        context = multiprocessing.get_context('spawn')
+        self.shards = []
+        self.targets = []
+        for index in range(num_shards):
+            shard_specs = target_specs[index::num_shards]
+            if not shard_specs:
+                continue
+            shard = ProxyShard(
+                index, proxy_target_cls, shard_specs, target_kwargs, context, self._shard_published
+            )
+            self.shards.append(shard)
+            self.targets.extend(ShardTargetView(name, url, shard) for (name, url) in shard_specs)
+
+        logging.debug(
+            "Proxy adapter split %d targets across %d shards", len(self.targets), len(self.shards)
+        )
+
+        # Build the parameter trees implemented by this adapter for the target views
+        self._build_proxy_trees()
+
+        # Launch the shard workers and wait for each to publish the initial state of its targets
+        for shard in self.shards:
+            shard.start()
+        for shard in self.shards:
+            try:
+                shard.ready.result(timeout=shard.reply_timeout + shard.STARTUP_TIMEOUT)
+            except futures.TimeoutError:
+                self._shard_error(
+                    shard.target_names, 408,
+                    "Proxy shard {} did not start within {:.1f} secs".format(
+                        shard.index, shard.reply_timeout + shard.STARTUP_TIMEOUT
+                    )
+                )
+            except ShardError as shard_error:
+                self._shard_error(shard.target_names, 502, str(shard_error))
+
+        self.start_history_refresh()
+
+    def proxy_get(self, path, get_metadata):
+        """
+        Get data from the proxy targets.
+
+        This method gets data from one or more specified targets via their shards and updates the
+        target views with the results.
+
+        :param path: path to data on remote targets
+        :param get_metadata: flag indicating if metadata is to be requested
+        :return: list of flags indicating if the request to each target was sent or shed
+        """
+        target_states = self._dispatch('get', path, lambda target_path: (target_path, get_metadata))
+        return [state is not None and state[4] for state in target_states]
+
+    def proxy_set(self, path, data, synchronous=False):
+        """
+        Set data on the proxy targets.
+
+        This method sets data on one or more specified targets via their shards and updates the
+        target views with the results.
+
+        :param path: path to data on remote targets
+        :param data: data to set on targets
+        :param synchronous: flag indicating the data must be sent to the targets immediately
+        :return: list of published target states, None for targets whose shard did not reply
+        """
+        return self._dispatch('set', path, lambda target_path: (target_path, data, synchronous))
+
+    def flush_writes(self):
+        """
+        Flush the write-behind queues of all proxy targets.
+
+        This method instructs each shard to send any writes pending for its targets immediately,
+        updating the target views with the state published by the shard after the flush.
+        """
+        replies = [(shard, shard.request('flush')) for shard in self.shards]
+        for (shard, reply) in replies:
+            states = self._await_reply(shard, shard.target_names, reply, time.monotonic())
+            for (name, state) in zip(shard.target_names, states or []):
+                self.target_map[name].update(state)
+
+    async def cleanup(self):
+        """
+        Clean up the state of the adapter.
+
+        This method stops any periodic history refresh and the shard worker processes, which flush
+        any pending writes to their targets before exiting.
+        """
+        self.stop_history_refresh()
+        for shard in self.shards:
+            shard.stop()
+        self.request_executor.shutdown()
+
+    def _dispatch(self, command, path, request_args):
+        """
+        Dispatch a command for the targets matching a path to their shards.
+
+        The command is sent to all the shards involved before waiting for any replies, allowing
+        the shards to handle their requests in parallel.
+
+        :param command: name of the command
+        :param path: path to data on remote targets
+        :param request_args: function returning the request arguments for a target path
+        :return: list of published target states, None for targets whose shard did not reply
+        """
+        # Resolve the path element and target path
+        path_elem, target_path = self._resolve_path(path)
+
+        # Group the requests for the matching targets by shard
+        shard_requests = {}
+        for target in self.targets:
+            if path_elem == '' or path_elem == target.name:
+                shard_requests.setdefault(target.shard, []).append(
+                    (target.name,) + request_args(target_path)
+                )
+
+        # Send the requests to each shard, then update the target views from the replies
+        start_time = time.monotonic()
+        replies = [
+            (shard, requests, shard.request(command, requests))
+            for (shard, requests) in shard_requests.items()
+        ]
+
+        target_states = []
+        for (shard, requests, reply) in replies:
+            names = [request[0] for request in requests]
+            states = self._await_reply(shard, names, reply, start_time)
+            if states is None:
+                target_states.extend([None] * len(requests))
+                continue
+            for (name, state) in zip(names, states):
+                self.target_map[name].update(state)
+                target_states.append(state)
+
+        return target_states
+
+    def _await_reply(self, shard, names, reply, start_time):
+        """
+        Wait for the reply of a shard to a command, until the reply deadline of the shard.
+
+        If no reply is received before the deadline, or the command failed, the status of the
+        targets involved is updated with the error. The worker is left running, so any reply
+        received after the deadline is discarded.
+
+        :param shard: the shard the command was sent to
+        :param names: names of the targets involved in the command
+        :param reply: future resolving to the reply
+        :param start_time: monotonic time at which the command was sent
+        :return: list of published target states, or None if no reply was received
+        """
+        try:
+            return reply.result(
+                timeout=max(0.0, start_time + shard.reply_timeout - time.monotonic())
+            )
+        except futures.TimeoutError:
+            self._shard_error(
+                names, 408, "Proxy shard {} did not reply within {:.1f} secs".format(
+                    shard.index, shard.reply_timeout
+                )
+            )
+        except ShardError as shard_error:
+            self._shard_error(names, 502, str(shard_error))
+        return None
+
+    def _shard_error(self, names, status_code, error_string):
+        """
+        Handle an error communicating with a shard, updating the status of the targets involved.
+
+        :param names: names of the targets involved
+        :param status_code: HTTP status code describing the error
+        :param error_string: description of the error
+        """
+        logging.error(error_string)
+        for name in names:
+            self.target_map[name].set_error(status_code, error_string)
+
+    def _shard_published(self, shard, initial_states):
+        """
+        Update the target views with the initial state published by a launch of a shard worker.
+
+        :param shard: the shard
+        :param initial_states: dict of lists of published states for each target of the shard
+        """
+        for (name, states) in initial_states.items():
+            for state in states:
+                self.target_map[name].update(state)